@@ -9,5 +9,10 @@ EXPORT int my_crypto_kem_keypair(uint8_t *pk, uint8_t *sk);
 EXPORT int my_crypto_kem_enc(uint8_t *ct, uint8_t *ss, const uint8_t *pk);
 EXPORT int my_crypto_kem_dec(uint8_t *ss, const uint8_t *ct, const uint8_t *sk);
 
+/* Batch variants: loop over n items laid out back to back in each buffer */
+EXPORT int my_crypto_kem_keypair_many(uint8_t *pk, uint8_t *sk, int n);
+EXPORT int my_crypto_kem_enc_many(uint8_t *ct, uint8_t *ss, const uint8_t *pk, int pk_stride, int n);
+EXPORT int my_crypto_kem_dec_many(uint8_t *ss, const uint8_t *ct, const uint8_t *sk, int sk_stride, int n);
+
 #endif
 
@@ -1,4 +1,5 @@
 #include "api.h"
+#include <stddef.h>
 
 int my_crypto_kem_keypair(unsigned char *pk, unsigned char *sk) {
 	    return pqcrystals_kyber768_ref_keypair(pk, sk);
@@ -12,3 +13,33 @@ int my_crypto_kem_dec(unsigned char *ss, const unsigned char *ct, const unsigned
 	    return pqcrystals_kyber768_ref_dec(ss, ct, sk);
 }
 
+int my_crypto_kem_keypair_many(unsigned char *pk, unsigned char *sk, int n) {
+	    for (int i = 0; i < n; i++) {
+	        int rc = pqcrystals_kyber768_ref_keypair(pk + (size_t)i * pqcrystals_kyber768_ref_PUBLICKEYBYTES,
+	                                                 sk + (size_t)i * pqcrystals_kyber768_ref_SECRETKEYBYTES);
+	        if (rc != 0) return rc;
+	    }
+	    return 0;
+}
+
+/* pk_stride is 0 to encapsulate n times against the same public key */
+int my_crypto_kem_enc_many(unsigned char *ct, unsigned char *ss, const unsigned char *pk, int pk_stride, int n) {
+	    for (int i = 0; i < n; i++) {
+	        int rc = pqcrystals_kyber768_ref_enc(ct + (size_t)i * pqcrystals_kyber768_ref_CIPHERTEXTBYTES,
+	                                             ss + (size_t)i * pqcrystals_kyber768_ref_BYTES,
+	                                             pk + (size_t)i * pk_stride);
+	        if (rc != 0) return rc;
+	    }
+	    return 0;
+}
+
+/* sk_stride is 0 to decapsulate every ciphertext with the same secret key */
+int my_crypto_kem_dec_many(unsigned char *ss, const unsigned char *ct, const unsigned char *sk, int sk_stride, int n) {
+	    for (int i = 0; i < n; i++) {
+	        int rc = pqcrystals_kyber768_ref_dec(ss + (size_t)i * pqcrystals_kyber768_ref_BYTES,
+	                                             ct + (size_t)i * pqcrystals_kyber768_ref_CIPHERTEXTBYTES,
+	                                             sk + (size_t)i * sk_stride);
+	        if (rc != 0) return rc;
+	    }
+	    return 0;
+}
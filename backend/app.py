@@ -1,79 +1,94 @@
-from flask import Flask
+from flask import Flask, jsonify
 from flask_cors import CORS
 from flask_jwt_extended import JWTManager
 import os
-import base64
-import json
 import warnings
-import firebase_admin
-from firebase_admin import credentials, firestore, initialize_app
 from dotenv import load_dotenv
+from firebase_init import get_db, use_db
 from routes.auth import auth_bp
-import redis
+from session_store import create_session_store, create_session_cache
+from outbox import create_outbox
+from username_index import create_username_index
+import kyber
+import metrics
 
 warnings.filterwarnings("ignore")
 load_dotenv()
 
-
-#redis setup
-redis_client = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=int(os.getenv('REDIS_PORT', 6379)),
-    db=int(os.getenv('REDIS_DB', 0)),
-    decode_responses=True
-)
-
-
-# Firebase initialization
-try:
-    firebase_creds_base64 = os.getenv('FIREBASE_CREDENTIALS')
-    if not firebase_creds_base64:
-        raise ValueError("FIREBASE_CREDENTIALS environment variable is not set")
-
-    # Padding fix
-    padding = 4 - (len(firebase_creds_base64) % 4)
-    if padding != 4:
-        firebase_creds_base64 += '=' * padding
-
-    firebase_creds_json = base64.b64decode(firebase_creds_base64).decode('utf-8')
-    firebase_creds_dict = json.loads(firebase_creds_json)
-
-    cred = credentials.Certificate(firebase_creds_dict)
+READY_CHECK_TIMEOUT = float(os.getenv("READY_CHECK_TIMEOUT", 2))
+
+
+def create_app(db=None, session_store=None):
+    """Build the Flask app without touching the network.
+
+    Firestore and Redis connections are opened by the first request that
+    needs them, so a dependency that is briefly down fails requests (and
+    /readyz) instead of the process. `db` and `session_store` replace the
+    configured backends, e.g. with in-memory ones.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config["JWT_SECRET_KEY"] = os.getenv('FLASK_JWT_SECRET')
+
+    if db is not None:
+        use_db(db)
+    # Redis unless SESSION_BACKEND=memory, connects on first use
+    app.session_store = session_store or create_session_store()
+    # Sessions cached per worker, loaded once per request by require_auth
+    app.session_cache = create_session_cache(app.session_store)
+    # Write-behind queue for new messages, None writes them synchronously
+    app.outbox = create_outbox(app.session_store, get_db)
+    # Username to user id lookups in Redis, None queries Firestore every time
+    app.username_index = create_username_index(app.session_store)
+
+    # Setup CORS for all API routes with credentials support
+    CORS(app, supports_credentials=True, expose_headers=["Retry-After"],
+         resources={r"/api/*": {"origins": "http://localhost:3000"}})
+
+    # JWT Manager
+    JWTManager(app)
+
+    # Register blueprints
+    app.register_blueprint(auth_bp)
+
+    # Request timings, Server-Timing headers and /metrics
+    metrics.init_app(app)
+
+    @app.route("/health/kyber", methods=["GET"])
+    def kyber_health():
+        status = kyber.health()
+        return jsonify(status), 200 if status["ok"] else 503
+
+    @app.route("/healthz", methods=["GET"])
+    def liveness():
+        # The process is up and serving, dependencies are checked by /readyz
+        return jsonify({"status": "ok"}), 200
+
+    @app.route("/readyz", methods=["GET"])
+    def readiness():
+        checks = {
+            "firestore": _check(lambda: get_db().collection("_health").document("ready").get(
+                timeout=READY_CHECK_TIMEOUT
+            )),
+            "session_store": _check(app.session_store.ping),
+            "kyber": "ok" if kyber.health()["ok"] else "library not loaded",
+        }
+        ready = all(state == "ok" for state in checks.values())
+        return jsonify({"status": "ok" if ready else "unavailable", "checks": checks}), 200 if ready else 503
+
+    return app
+
+
+def _check(probe):
     try:
-        firebase_app = firebase_admin.get_app()
-    except ValueError:
-        firebase_app = initialize_app(cred)
-
-    db = firestore.client(app=firebase_app)
-    print("Firestore client initialized successfully")
-
-except Exception as e:
-    print(f"Firebase initialization error: {e}")
-    exit(1)
-
-
-try:
-    redis_client.ping()
-    print("Redis client initialized successfully")
-except redis.exceptions.ConnectionError:
-    print("Redis connection failed.")
-    exit(1)
-
-
-# App setup
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config["JWT_SECRET_KEY"] = os.getenv('FLASK_JWT_SECRET')
-app.redis_client = redis_client
+        probe()
+        return "ok"
+    except Exception as e:
+        return f"error: {e}"
 
-# Setup CORS for all API routes with credentials support
-CORS(app, supports_credentials=True, resources={r"/api/*": {"origins": "http://localhost:3000"}})
 
-# JWT Manager
-jwt = JWTManager(app)
+app = create_app()
 
-# Register blueprints
-app.register_blueprint(auth_bp)
 
 if __name__ == '__main__':
     print("Starting Flask app...")
@@ -0,0 +1,60 @@
+# Adds the conversation_id and sent_at fields to message documents written
+# before get_messages switched to a single per-conversation query. sent_at is
+# taken from the stored ISO timestamp, so old messages keep their order.
+#
+# Deploy the indexes first: firebase deploy --only firestore:indexes
+# Usage: python backfill_conversations.py [--dry-run] [--batch-size 400]
+
+import argparse
+from datetime import datetime
+from firebase_init import init_firestore
+from models.message import Message
+
+
+def backfill(db, batch_size=400, dry_run=False):
+    """Fill in missing conversation fields, returns (updated, skipped) counts."""
+    updated = skipped = 0
+    messages_ref = db.collection("messages")
+    last_doc = None
+
+    while True:
+        query = messages_ref.order_by("__name__").limit(batch_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+
+        batch = db.batch()
+        pending = 0
+        for doc in docs:
+            data = doc.to_dict()
+            update = {}
+            if "conversation_id" not in data:
+                update["conversation_id"] = Message.conversation_id(data["from"], data["to"])
+            if "sent_at" not in data:
+                update["sent_at"] = datetime.fromisoformat(data["timestamp"])
+            if not update:
+                skipped += 1
+                continue
+            batch.update(doc.reference, update)
+            pending += 1
+
+        if pending and not dry_run:
+            batch.commit()
+        updated += pending
+        print(f"Processed {updated + skipped} messages ({updated} updated)")
+
+    return updated, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Add conversation_id and sent_at to existing messages")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    parser.add_argument("--batch-size", type=int, default=400, help="messages per page and write batch (max 500)")
+    args = parser.parse_args()
+
+    updated, skipped = backfill(init_firestore(), batch_size=min(args.batch_size, 500), dry_run=args.dry_run)
+    action = "Would update" if args.dry_run else "Updated"
+    print(f"{action} {updated} messages, {skipped} already up to date")
@@ -0,0 +1 @@
+# Benchmark suite, run from the backend directory with: python -m benchmarks
@@ -0,0 +1,51 @@
+# Usage: python -m benchmarks [--filter kyber] [--quick] [--output results.json]
+#                             [--compare baseline.json] [--threshold 0.1]
+
+import argparse
+import os
+import sys
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks import core
+from benchmarks import bench_crypto, bench_routes  # noqa: F401, registers the benchmarks
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the crypto primitives and API routes")
+    parser.add_argument("--filter", help="only run benchmarks whose name contains this text")
+    parser.add_argument("--quick", action="store_true", help="fewer iterations, for a rough check")
+    parser.add_argument("--output", help="result file, defaults to benchmarks/results/<timestamp>.json")
+    parser.add_argument("--compare", help="earlier result file to compare medians against")
+    parser.add_argument("--threshold", type=float, default=0.1,
+                        help="relative slowdown reported as a regression (default 0.1)")
+    args = parser.parse_args()
+
+    results = []
+    for bench in core.registered(args.filter):
+        entry = core.run(bench, scale=0.2 if args.quick else 1.0)
+        core.report(entry)
+        results.append(entry)
+
+    stamp = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    path = core.save(results, args.output or os.path.join(RESULTS_DIR, f"{stamp}.json"))
+    print(f"Results written to {path}")
+
+    failed = [entry["name"] for entry in results if "failed" in entry]
+    if failed:
+        print(f"{len(failed)} benchmark(s) failed: {', '.join(failed)}")
+
+    if args.compare:
+        regressed = core.compare(results, args.compare, args.threshold)
+        if regressed:
+            print(f"{len(regressed)} benchmark(s) slower than the baseline by more than {args.threshold:.0%}")
+            sys.exit(1)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,108 @@
+# ---- Kyber and AES primitives ----
+
+import os
+import secrets
+from benchmarks.core import benchmark, require_kyber
+from benchmarks.fake_kem import use_fake_kem
+from envelope import pack_key_wrap, pack_payload, key_wrap_id
+import kyber
+import security
+
+
+@benchmark("kyber.keygen", number=100)
+def kyber_keygen():
+    return require_kyber().generate_keypair
+
+
+@benchmark("kyber.keygen_batch_16", number=10)
+def kyber_keygen_batch():
+    wrapper = require_kyber()
+    return lambda: wrapper.generate_keypairs(16)
+
+
+@benchmark("kyber.encapsulate", number=100)
+def kyber_encapsulate():
+    wrapper = require_kyber()
+    public_key, _ = wrapper.generate_keypair()
+    public_key = bytes.fromhex(public_key)
+    return lambda: wrapper.encapsulate(public_key)
+
+
+@benchmark("kyber.decapsulate", number=100)
+def kyber_decapsulate():
+    wrapper = require_kyber()
+    public_key, private_key = wrapper.generate_keypair()
+    ciphertext, _ = wrapper.encapsulate(bytes.fromhex(public_key))
+    private_key = bytes.fromhex(private_key)
+    return lambda: wrapper.decapsulate(ciphertext, private_key)
+
+
+@benchmark("security.encrypt_secret_key", number=3)
+def encrypt_secret_key():
+    private_key = os.urandom(kyber.SECRETKEYBYTES).hex()
+    salt, iv = os.urandom(16), os.urandom(16)
+    return lambda: security.encrypt_secret_key(private_key, "Passw0rd!", salt, iv)
+
+
+@benchmark("security.decrypt_secret_key", number=3)
+def decrypt_secret_key():
+    salt, iv = os.urandom(16), os.urandom(16)
+    encrypted = security.encrypt_secret_key(os.urandom(kyber.SECRETKEYBYTES).hex(), "Passw0rd!", salt, iv)
+    return lambda: security.decrypt_secret_key(encrypted.hex(), "Passw0rd!", salt.hex(), iv.hex())
+
+
+@benchmark("security.encrypt_message_cbc", number=2000)
+def encrypt_message_cbc():
+    aes_key, iv = secrets.token_bytes(32), secrets.token_bytes(16)
+    return lambda: security.encrypt_message(aes_key, "hello " * 20, iv)
+
+
+@benchmark("security.seal_message_gcm", number=2000)
+def seal_message_gcm():
+    aes_key = secrets.token_bytes(32)
+    return lambda: security.seal_message(aes_key, "hello " * 20, "alice", "bob", cache_scope="bench", cache_ttl=600)
+
+
+def _stored_message(wrapper, payload_cipher):
+    # A message from alice to bob in the layout chat_message writes
+    public_key, private_key = wrapper.generate_keypair()
+    aes_key = secrets.token_bytes(32)
+    ct, encrypted_key, iv = security.encrypt_aes_key(bytes.fromhex(public_key), aes_key)
+    wrap = pack_key_wrap({
+        "sender_ciphertext": ct, "sender_encrypted_key": encrypted_key, "sender_iv": iv,
+        "receiver_ciphertext": ct, "receiver_encrypted_key": encrypted_key, "receiver_iv": iv,
+    })
+    envelope_id = key_wrap_id(wrap)
+    if payload_cipher == "gcm":
+        envelope = security.seal_message(aes_key, "hello " * 20, "alice", "bob")
+    else:
+        iv_message = secrets.token_bytes(16)
+        envelope = pack_payload(security.encrypt_message(aes_key, "hello " * 20, iv_message), iv_message)
+    doc = {"from": "alice", "to": "bob", "envelope_id": envelope_id, "envelope": envelope}
+    return doc, {envelope_id: {"wrap": wrap}}, bytes.fromhex(private_key)
+
+
+@benchmark("security.decrypt_message_cold", number=200)
+def decrypt_message_cold():
+    doc, key_envelopes, private_key = _stored_message(require_kyber(), "gcm")
+    return lambda: security.decrypt_message(doc, "bob", private_key, key_envelopes=key_envelopes)
+
+
+@benchmark("security.decrypt_message_cached_cbc", number=2000)
+@use_fake_kem
+def decrypt_message_cached_cbc():
+    # The key is unwrapped once in the warm-up call, the rest is AES
+    doc, key_envelopes, private_key = _stored_message(kyber.get_kyber(), "cbc")
+    return lambda: security.decrypt_message(
+        doc, "bob", private_key, cache_scope="bench", cache_ttl=600, key_envelopes=key_envelopes
+    )
+
+
+@benchmark("security.decrypt_message_cached_gcm", number=2000)
+@use_fake_kem
+def decrypt_message_cached_gcm():
+    # The key is unwrapped once in the warm-up call, the rest is AES
+    doc, key_envelopes, private_key = _stored_message(kyber.get_kyber(), "gcm")
+    return lambda: security.decrypt_message(
+        doc, "bob", private_key, cache_scope="bench", cache_ttl=600, key_envelopes=key_envelopes
+    )
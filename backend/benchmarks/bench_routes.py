@@ -0,0 +1,104 @@
+# ---- End-to-end route timings through the Flask test client ----
+#
+# Requests run against an in-memory Firestore, the in-memory session store
+# and the deterministic fake KEM, so the numbers cover the backend's own work
+# without network or KEM time, and they run wherever Python does.
+
+import itertools
+import secrets
+import jwt
+from benchmarks.core import benchmark
+from benchmarks.fake_firestore import FakeFirestore
+from benchmarks.fake_kem import use_fake_kem
+from session_store import MemorySessionStore
+
+PASSWORD = "Passw0rd!bench"
+HISTORY_SIZE = 500
+
+_names = (f"bench{i}" for i in itertools.count())
+
+
+class _Backend:
+    """Flask app wired to fresh in-memory backends."""
+
+    def __init__(self):
+        from app import create_app
+
+        app = create_app(db=FakeFirestore(), session_store=MemorySessionStore())
+        self.secret = secrets.token_hex(32)
+        app.config["JWT_SECRET_KEY"] = self.secret
+        self.client = app.test_client()
+
+    def post(self, path, expected=200, **kwargs):
+        response = self.client.post(path, **kwargs)
+        if response.status_code != expected:
+            raise RuntimeError(f"POST {path} returned {response.status_code}: {response.get_data(as_text=True)}")
+        return response
+
+    def get(self, path, **kwargs):
+        response = self.client.get(path, **kwargs)
+        if response.status_code != 200:
+            raise RuntimeError(f"GET {path} returned {response.status_code}: {response.get_data(as_text=True)}")
+        return response
+
+    def register(self):
+        username = next(_names)
+        self.post("/api/register", expected=201, json={
+            "username": username, "password": PASSWORD, "confirm_password": PASSWORD,
+        })
+        return username
+
+    def login(self, username):
+        token = self.post("/api/login", json={"username": username, "password": PASSWORD}).get_json()["token"]
+        user_id = jwt.decode(token, self.secret, algorithms=["HS256"])["user_id"]
+        return user_id, {"Authorization": f"Bearer {token}"}
+
+    def conversation(self, messages=0):
+        """Two logged-in users and `messages` messages between them."""
+        alice = self.login(self.register())
+        bob = self.login(self.register())
+        for i in range(messages):
+            sender, receiver = (alice, bob) if i % 2 == 0 else (bob, alice)
+            self.post(f"/api/friend/{receiver[0]}/message{i}", headers=sender[1])
+        return alice, bob
+
+
+@benchmark("route.register", number=3)
+@use_fake_kem
+def register():
+    backend = _Backend()
+    return backend.register
+
+
+@benchmark("route.login", number=3)
+@use_fake_kem
+def login():
+    backend = _Backend()
+    username = backend.register()
+    return lambda: backend.login(username)
+
+
+@benchmark("route.chat_message", number=100)
+@use_fake_kem
+def chat_message():
+    backend = _Backend()
+    (_, alice_headers), (bob_id, _) = backend.conversation()
+    return lambda: backend.post(f"/api/friend/{bob_id}/hello", headers=alice_headers)
+
+
+@benchmark(f"route.get_messages_{HISTORY_SIZE}", number=5)
+@use_fake_kem
+def get_messages():
+    backend = _Backend()
+    (_, alice_headers), (bob_id, _) = backend.conversation(HISTORY_SIZE)
+    path = f"/api/get_messages/{bob_id}?limit={HISTORY_SIZE}"
+    return lambda: backend.get(path, headers=alice_headers)
+
+
+@benchmark(f"route.get_messages_{HISTORY_SIZE}_ndjson", number=5)
+@use_fake_kem
+def get_messages_ndjson():
+    backend = _Backend()
+    (_, alice_headers), (bob_id, _) = backend.conversation(HISTORY_SIZE)
+    path = f"/api/get_messages/{bob_id}?limit={HISTORY_SIZE}&format=ndjson"
+    return lambda: backend.get(path, headers=alice_headers).get_data()
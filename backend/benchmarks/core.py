@@ -0,0 +1,147 @@
+# ---- Benchmark registry, timing and result files ----
+
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+_registry = []
+
+
+class Skip(Exception):
+    """Raised by a benchmark setup when it cannot run in this environment."""
+
+
+def require_kyber():
+    """The Kyber wrapper, raises Skip unless the real library is loaded."""
+    import kyber
+
+    try:
+        wrapper = kyber.get_kyber()
+    except RuntimeError as e:
+        raise Skip(str(e))
+    if kyber.health()["library"] == "mock":
+        raise Skip("only the mock KEM is available")
+    return wrapper
+
+
+def benchmark(name, number=10, repeat=5):
+    """Register a benchmark.
+
+    The decorated function is the setup: it runs once, untimed, and returns
+    the zero-argument callable that gets timed. Each of `repeat` rounds
+    calls it `number` times.
+    """
+    def register(setup):
+        _registry.append({"name": name, "setup": setup, "number": number, "repeat": repeat})
+        return setup
+    return register
+
+
+def registered(pattern=None):
+    return [bench for bench in _registry if not pattern or pattern in bench["name"]]
+
+
+def measure(fn, number, repeat):
+    """Per-call timings in seconds, one entry per round, after a warm-up call."""
+    fn()
+    rounds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        rounds.append((time.perf_counter() - start) / number)
+    return rounds
+
+
+def run(bench, scale=1.0):
+    """Run one registered benchmark, returns its result entry.
+
+    A benchmark that raises is reported as failed, the others still run.
+    """
+    number = max(1, int(bench["number"] * scale))
+    repeat = max(3, int(bench["repeat"] * scale)) if scale < 1 else bench["repeat"]
+    try:
+        fn = bench["setup"]()
+        rounds = measure(fn, number, repeat)
+    except Skip as e:
+        return {"name": bench["name"], "skipped": str(e)}
+    except Exception as e:
+        return {"name": bench["name"], "failed": f"{type(e).__name__}: {e}"}
+    return {
+        "name": bench["name"],
+        "number": number,
+        "repeat": repeat,
+        "min": min(rounds),
+        "median": statistics.median(rounds),
+        "mean": statistics.fmean(rounds),
+        "stdev": statistics.stdev(rounds) if len(rounds) > 1 else 0.0,
+    }
+
+
+def environment():
+    """Settings that change what the numbers mean, stored with every run."""
+    import kyber
+    import security
+
+    return {
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "kyber": kyber.health()["library"],
+        "pbkdf2_iterations": security.PBKDF2_ITERATIONS,
+        "bcrypt_rounds": security.BCRYPT_ROUNDS,
+    }
+
+
+def save(results, path):
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    document = {
+        "created_at": datetime.now(timezone.utc).isoformat(),
+        "environment": environment(),
+        "results": results,
+    }
+    with open(path, "w") as f:
+        json.dump(document, f, indent=2)
+    return path
+
+
+def compare(results, baseline_path, threshold):
+    """Print the median change against a saved run, returns the names that regressed."""
+    with open(baseline_path) as f:
+        baseline = {entry["name"]: entry for entry in json.load(f)["results"]}
+
+    regressed = []
+    for entry in results:
+        old = baseline.get(entry["name"])
+        if "median" not in entry or not old or "median" not in old:
+            continue
+        change = entry["median"] / old["median"] - 1
+        marker = ""
+        if change > threshold:
+            marker = "  <-- slower"
+            regressed.append(entry["name"])
+        elif change < -threshold:
+            marker = "  faster"
+        print(f"{entry['name']:<40} {_format(old['median'])} -> {_format(entry['median'])} ({change:+.1%}){marker}")
+    return regressed
+
+
+def _format(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("us", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds / scale:8.2f} {unit}"
+    return f"{seconds / 1e-9:8.2f} ns"
+
+
+def report(entry):
+    if "skipped" in entry:
+        print(f"{entry['name']:<40} skipped: {entry['skipped']}")
+    elif "failed" in entry:
+        print(f"{entry['name']:<40} failed: {entry['failed']}")
+    else:
+        print(f"{entry['name']:<40} {_format(entry['median'])}  (min {_format(entry['min']).strip()}, "
+              f"stdev {_format(entry['stdev']).strip()}, {entry['repeat']}x{entry['number']})")
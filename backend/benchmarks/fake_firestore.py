@@ -0,0 +1,256 @@
+# ---- In-memory stand-in for the Firestore client ----
+#
+# Covers what the backend uses: documents, where/order_by/limit/select
+# queries with start_at/start_after/end_before cursors, count(), get_all,
+# write batches and the SERVER_TIMESTAMP, DELETE_FIELD, ArrayUnion and
+# ArrayRemove sentinels. Queries scan the whole collection, so it is only
+# meant for benchmarks.
+
+import copy
+import itertools
+import operator
+import uuid
+from datetime import datetime, timezone
+from google.cloud.firestore_v1 import transforms
+
+_OPERATORS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+    "in": lambda value, options: value in options,
+    "array_contains": lambda value, item: item in (value or []),
+}
+
+
+def _apply(current, data):
+    updated = dict(current or {})
+    for field, value in data.items():
+        if value is transforms.SERVER_TIMESTAMP:
+            updated[field] = datetime.now(timezone.utc)
+        elif value is transforms.DELETE_FIELD:
+            updated.pop(field, None)
+        elif isinstance(value, transforms.ArrayUnion):
+            items = list(updated.get(field, []))
+            items.extend(item for item in value.values if item not in items)
+            updated[field] = items
+        elif isinstance(value, transforms.ArrayRemove):
+            updated[field] = [item for item in updated.get(field, []) if item not in value.values]
+        else:
+            updated[field] = copy.deepcopy(value)
+    return updated
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+    def get(self, field):
+        return self._data[field]
+
+
+class FakeDocument:
+    def __init__(self, collection, doc_id):
+        self._collection = collection
+        self.id = doc_id
+
+    @property
+    def _docs(self):
+        return self._collection.docs
+
+    def get(self, field_paths=None, **kwargs):
+        data = self._docs.get(self.id)
+        if data is not None and field_paths:
+            data = {field: data[field] for field in field_paths if field in data}
+        return FakeSnapshot(self, copy.deepcopy(data))
+
+    def set(self, data, merge=False):
+        self._docs[self.id] = _apply(self._docs.get(self.id) if merge else None, data)
+
+    def create(self, data):
+        if self.id in self._docs:
+            raise ValueError(f"Document {self.id} already exists")
+        self.set(data)
+
+    def update(self, data):
+        if self.id not in self._docs:
+            raise KeyError(f"Document {self.id} not found")
+        self._docs[self.id] = _apply(self._docs[self.id], data)
+
+    def delete(self):
+        self._docs.pop(self.id, None)
+
+    def collection(self, name):
+        return self._collection.db.collection(f"{self._collection.name}/{self.id}/{name}")
+
+
+class FakeQuery:
+    def __init__(self, collection, filters=(), orders=(), limit=None, start=None, end=None, fields=None):
+        self._collection = collection
+        self._filters = filters
+        self._orders = orders
+        self._limit = limit
+        # Cursors are (values, inclusive)
+        self._start = start
+        self._end = end
+        self._fields = fields
+
+    def _copy(self, **changes):
+        state = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "start": self._start,
+            "end": self._end,
+            "fields": self._fields,
+        }
+        state.update(changes)
+        return FakeQuery(self._collection, **state)
+
+    def where(self, field, op, value):
+        return self._copy(filters=self._filters + ((field, _OPERATORS[op], value),))
+
+    def order_by(self, field, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field, direction),))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def _cursor(self, cursor):
+        if isinstance(cursor, FakeSnapshot):
+            values = dict(cursor._data or {}, __name__=cursor.id)
+        else:
+            values = dict(cursor)
+        name = values.get("__name__")
+        if name is not None and not isinstance(name, str):
+            values["__name__"] = name.id
+        return [values[field] for field, _ in self._orders]
+
+    def start_at(self, cursor):
+        return self._copy(start=(self._cursor(cursor), True))
+
+    def start_after(self, cursor):
+        return self._copy(start=(self._cursor(cursor), False))
+
+    def end_before(self, cursor):
+        return self._copy(end=(self._cursor(cursor), False))
+
+    def _compare(self, row, values):
+        """-1, 0 or 1 as the row sorts before, at or after the cursor values."""
+        for (field, direction), value in zip(self._orders, values):
+            current = row[0] if field == "__name__" else row[1][field]
+            if current != value:
+                result = -1 if current < value else 1
+                return -result if direction == "DESCENDING" else result
+        return 0
+
+    def select(self, field_paths):
+        return self._copy(fields=tuple(field_paths))
+
+    def stream(self, **kwargs):
+        rows = [
+            (doc_id, data) for doc_id, data in self._collection.docs.items()
+            if all(field in data and op(data[field], value) for field, op, value in self._filters)
+            and all(field == "__name__" or field in data for field, _ in self._orders)
+        ]
+        # Stable sorts applied last key first give a multi-key ordering
+        for field, direction in reversed(self._orders):
+            rows.sort(
+                key=lambda row: row[0] if field == "__name__" else row[1][field],
+                reverse=direction == "DESCENDING",
+            )
+        if self._start is not None:
+            values, inclusive = self._start
+            rows = [row for row in rows if self._compare(row, values) >= (0 if inclusive else 1)]
+        if self._end is not None:
+            values, _ = self._end
+            rows = [row for row in rows if self._compare(row, values) < 0]
+        for doc_id, data in itertools.islice(rows, self._limit):
+            if self._fields is not None:
+                data = {field: data[field] for field in self._fields if field in data}
+            yield FakeSnapshot(FakeDocument(self._collection, doc_id), copy.deepcopy(data))
+
+    def get(self, **kwargs):
+        return list(self.stream())
+
+    def count(self, alias=None):
+        return FakeAggregation(self)
+
+
+class FakeAggregation:
+    def __init__(self, query):
+        self._query = query
+
+    def get(self, **kwargs):
+        return [[FakeAggregationResult(sum(1 for _ in self._query.stream()))]]
+
+
+class FakeAggregationResult:
+    def __init__(self, value):
+        self.value = value
+
+
+class FakeCollection(FakeQuery):
+    def __init__(self, db, name):
+        super().__init__(self)
+        self.db = db
+        self.name = name
+        self.docs = {}
+
+    def document(self, doc_id=None):
+        return FakeDocument(self, doc_id or uuid.uuid4().hex[:20])
+
+    def add(self, data, document_id=None):
+        reference = self.document(document_id)
+        reference.set(data)
+        return datetime.now(timezone.utc), reference
+
+
+class FakeBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference.set(data, merge=merge))
+
+    def create(self, reference, data):
+        self._writes.append(lambda: reference.create(data))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: reference.update(data))
+
+    def delete(self, reference):
+        self._writes.append(reference.delete)
+
+    def commit(self):
+        for write in self._writes:
+            write()
+        self._writes = []
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._collections = {}
+
+    def collection(self, name):
+        if name not in self._collections:
+            self._collections[name] = FakeCollection(self, name)
+        return self._collections[name]
+
+    def get_all(self, references, field_paths=None, **kwargs):
+        for reference in references:
+            yield reference.get(field_paths=field_paths)
+
+    def batch(self):
+        return FakeBatch()
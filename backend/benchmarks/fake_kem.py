@@ -0,0 +1,86 @@
+# ---- Deterministic stand-in for the Kyber library ----
+#
+# Route benchmarks measure the backend's own work, so they run on this
+# everywhere instead of skipping where libkyber cannot be loaded. Keys,
+# ciphertexts and shared secrets have Kyber-768 sizes and decapsulation
+# recovers the encapsulated secret, but nothing here is secure. KEM cost
+# itself is covered by the kyber.* benchmarks on the real library.
+
+import ctypes
+import functools
+import hashlib
+import itertools
+from contextlib import contextmanager
+import kyber
+
+
+def _fill(buffer, data):
+    ctypes.memmove(buffer, data, len(data))
+
+
+def _public_key(secret_key):
+    return hashlib.shake_256(b"pk" + secret_key).digest(kyber.PUBLICKEYBYTES)
+
+
+class _FakeLibrary:
+    """The single-item entry points of libkyber, writing into ctypes buffers."""
+
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def _next(self):
+        return next(self._counter).to_bytes(8, "big")
+
+    def my_crypto_kem_keypair(self, pk, sk):
+        secret_key = hashlib.shake_256(b"sk" + self._next()).digest(kyber.SECRETKEYBYTES)
+        _fill(sk, secret_key)
+        _fill(pk, _public_key(secret_key))
+        return 0
+
+    def my_crypto_kem_enc(self, ct, ss, pk):
+        public_key = bytes(pk)
+        ciphertext = hashlib.shake_256(b"ct" + self._next() + public_key).digest(kyber.CIPHERTEXTBYTES)
+        _fill(ct, ciphertext)
+        _fill(ss, hashlib.sha256(public_key + ciphertext).digest())
+        return 0
+
+    def my_crypto_kem_dec(self, ss, ct, sk):
+        _fill(ss, hashlib.sha256(_public_key(bytes(sk)) + bytes(ct)).digest())
+        return 0
+
+
+class FakeKyberWrapper(kyber.KyberWrapper):
+    """KyberWrapper over _FakeLibrary, every wrapper code path stays the same."""
+
+    def __init__(self):
+        self.lib_path = "benchmarks.fake_kem"
+        self.kyber = _FakeLibrary()
+        self.has_batch = False
+
+
+_wrapper = FakeKyberWrapper()
+
+
+@contextmanager
+def installed():
+    """Serve kyber.get_kyber() from the fake for the duration of the block."""
+    previous = kyber._instance
+    kyber._instance = _wrapper
+    try:
+        yield _wrapper
+    finally:
+        kyber._instance = previous
+
+
+def use_fake_kem(setup):
+    """Run a benchmark's setup and each timed call on the fake KEM."""
+    @functools.wraps(setup)
+    def wrapped():
+        with installed():
+            fn = setup()
+
+        def call():
+            with installed():
+                return fn()
+        return call
+    return wrapped
@@ -0,0 +1,133 @@
+# ---- Binary storage format for chat messages ----
+#
+# Byte strings are serialized as:
+#
+#   version (1 byte) | for each field: length (4 bytes, big endian) | bytes
+#
+# A message document stores its ciphertext as one Firestore bytes field,
+# "envelope". Version 1 carries the payload and both KEM wraps of the
+# session AES key inline. Version 2 carries only the payload and points at a
+# document in the key_envelopes collection through "envelope_id", so the
+# wraps, identical for every message of a session, are stored once.
+# Version 3 has the same layout as version 2, but its payload is sealed with
+# AES-256-GCM: "message" is ciphertext plus tag and "iv_message" the nonce.
+# Versions 1 and 2 hold AES-256-CBC ciphertext.
+#
+# Documents written before the envelope existed hold every field as a hex
+# string; read_message_fields() understands all three layouts.
+
+import hashlib
+import struct
+
+ENVELOPE_V1 = 1
+ENVELOPE_V2 = 2
+ENVELOPE_V3 = 3
+KEY_WRAP_V1 = 1
+
+CIPHER_CBC = "aes-256-cbc"
+CIPHER_GCM = "aes-256-gcm"
+
+PAYLOAD_FIELDS = ("message", "iv_message")
+
+WRAP_FIELDS = (
+    "sender_ciphertext",
+    "sender_encrypted_key",
+    "sender_iv",
+    "receiver_ciphertext",
+    "receiver_encrypted_key",
+    "receiver_iv",
+)
+
+MESSAGE_FIELDS = PAYLOAD_FIELDS + WRAP_FIELDS
+
+_LENGTH = struct.Struct(">I")
+
+
+def pack_fields(version, values):
+    """Serialize a sequence of byte strings behind a version tag."""
+    parts = [bytes([version])]
+    for value in values:
+        parts.append(_LENGTH.pack(len(value)))
+        parts.append(bytes(value))
+    return b"".join(parts)
+
+
+def unpack_fields(blob):
+    """Inverse of pack_fields, returns (version, [bytes, ...])."""
+    view = memoryview(blob)
+    if not view:
+        raise ValueError("Empty envelope")
+    version = view[0]
+    values = []
+    offset = 1
+    while offset < len(view):
+        (length,) = _LENGTH.unpack_from(view, offset)
+        offset += _LENGTH.size
+        if offset + length > len(view):
+            raise ValueError("Truncated envelope")
+        values.append(bytes(view[offset:offset + length]))
+        offset += length
+    return version, values
+
+
+def pack_message(fields):
+    """Build a self-contained (version 1) envelope from every entry of MESSAGE_FIELDS."""
+    return pack_fields(ENVELOPE_V1, [fields[name] for name in MESSAGE_FIELDS])
+
+
+def pack_payload(encrypted_message, iv_message):
+    """Build a version 2 envelope, whose key wraps live in key_envelopes."""
+    return pack_fields(ENVELOPE_V2, [encrypted_message, iv_message])
+
+
+def pack_sealed_payload(encrypted_message, nonce):
+    """Build a version 3 envelope from AES-GCM ciphertext plus tag and its nonce."""
+    return pack_fields(ENVELOPE_V3, [encrypted_message, nonce])
+
+
+def pack_key_wrap(fields):
+    """Serialize both KEM wraps of a session AES key for a key_envelopes document."""
+    return pack_fields(KEY_WRAP_V1, [fields[name] for name in WRAP_FIELDS])
+
+
+def key_wrap_id(wrap):
+    """Content-derived document id, so writing the same wrap twice is a no-op."""
+    return hashlib.sha256(wrap).hexdigest()[:32]
+
+
+def read_key_wrap(envelope_doc):
+    """KEM wraps stored in a key_envelopes document, as a dict of bytes."""
+    version, values = unpack_fields(envelope_doc["wrap"])
+    if version != KEY_WRAP_V1 or len(values) != len(WRAP_FIELDS):
+        raise ValueError(f"Unsupported key envelope version {version}")
+    return dict(zip(WRAP_FIELDS, values))
+
+
+def read_message_fields(doc, key_envelopes=None):
+    """Ciphertext and key material of a stored message, as a dict of bytes.
+
+    The "cipher" entry names the payload cipher, CIPHER_CBC or CIPHER_GCM.
+    `key_envelopes` maps envelope ids to key_envelopes documents and is
+    needed for version 2 and 3 messages.
+    """
+    blob = doc.get("envelope")
+    if blob is None:
+        # Legacy document with hex-encoded fields
+        fields = {name: bytes.fromhex(doc[name]) for name in MESSAGE_FIELDS}
+        fields["cipher"] = CIPHER_CBC
+        return fields
+
+    version, values = unpack_fields(blob)
+    if version == ENVELOPE_V1 and len(values) == len(MESSAGE_FIELDS):
+        fields = dict(zip(MESSAGE_FIELDS, values))
+        fields["cipher"] = CIPHER_CBC
+        return fields
+    if version in (ENVELOPE_V2, ENVELOPE_V3) and len(values) == len(PAYLOAD_FIELDS):
+        envelope_id = doc.get("envelope_id")
+        if not key_envelopes or envelope_id not in key_envelopes:
+            raise ValueError(f"Key envelope {envelope_id} not found")
+        fields = read_key_wrap(key_envelopes[envelope_id])
+        fields.update(zip(PAYLOAD_FIELDS, values))
+        fields["cipher"] = CIPHER_GCM if version == ENVELOPE_V3 else CIPHER_CBC
+        return fields
+    raise ValueError(f"Unsupported message envelope version {version}")
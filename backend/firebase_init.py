@@ -0,0 +1,64 @@
+import os
+import base64
+import json
+import threading
+import firebase_admin
+from firebase_admin import credentials, firestore, initialize_app
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def init_firestore():
+    """Initialize the Firebase app from FIREBASE_CREDENTIALS and return a Firestore client."""
+    firebase_creds_base64 = os.getenv('FIREBASE_CREDENTIALS')
+    if not firebase_creds_base64:
+        raise ValueError("FIREBASE_CREDENTIALS environment variable is not set")
+
+    # Padding fix
+    padding = 4 - (len(firebase_creds_base64) % 4)
+    if padding != 4:
+        firebase_creds_base64 += '=' * padding
+
+    firebase_creds_json = base64.b64decode(firebase_creds_base64).decode('utf-8')
+    firebase_creds_dict = json.loads(firebase_creds_json)
+
+    cred = credentials.Certificate(firebase_creds_dict)
+    try:
+        firebase_app = firebase_admin.get_app()
+    except ValueError:
+        firebase_app = initialize_app(cred)
+
+    return firestore.client(app=firebase_app)
+
+
+# ---- Process-wide client ----
+
+_db = None
+_db_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # gRPC channels do not survive a fork, each worker builds its own client
+    global _db, _db_lock
+    _db = None
+    _db_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def get_db():
+    """Firestore client shared by every request of this process, created on first use."""
+    global _db
+    if _db is None:
+        with _db_lock:
+            if _db is None:
+                _db = init_firestore()
+    return _db
+
+
+def use_db(db):
+    """Serve `db` from get_db(), e.g. an in-memory stand-in for benchmarks."""
+    global _db
+    _db = db
@@ -0,0 +1,36 @@
+# Gunicorn settings, start the backend with: gunicorn -c gunicorn.conf.py app:app
+import os
+import tempfile
+
+# Workers share their metrics through this directory, so /metrics covers all of them
+os.environ.setdefault("METRICS_DIR", os.path.join(tempfile.gettempdir(), "pqmessenger-metrics"))
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:5000")
+workers = int(os.getenv("GUNICORN_WORKERS", 2))
+# Threaded workers. Message streams belong on the gevent service in
+# gunicorn.stream.conf.py; one served here holds a thread, so routes.auth
+# caps them at STREAM_MAX_PER_WORKER (a quarter of the threads by default)
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", 8))
+# Import the app and load the Kyber library once in the master, workers
+# inherit both when they fork. Firestore and Redis connect lazily in each
+# worker, so no socket is shared across the fork.
+preload_app = True
+
+
+def on_starting(server):
+    from kyber import preload
+    from metrics import clear_dir
+    preload()
+    # Snapshots of an earlier run would be added to this one
+    clear_dir()
+
+
+def post_fork(server, worker):
+    # Start filling the keypair pool and flushing queued messages before the
+    # worker takes its first request
+    from app import app
+    from keypool import keypair_pool
+    keypair_pool.start()
+    if app.outbox is not None:
+        app.outbox.start()
@@ -0,0 +1,23 @@
+# Gunicorn settings for the message stream service, start it next to the API with:
+#   gunicorn -c gunicorn.stream.conf.py app:app
+# and point the frontend's REACT_APP_STREAM_URL at it. Only /api/stream is
+# meant to be routed here: an open stream is a greenlet, not a request thread,
+# so one worker holds thousands of them.
+import os
+
+bind = os.getenv("STREAM_BIND", "0.0.0.0:5001")
+workers = int(os.getenv("STREAM_WORKERS", 1))
+worker_class = "gevent"
+worker_connections = int(os.getenv("STREAM_WORKER_CONNECTIONS", 1000))
+# Leave a few connections for requests that are turned away with 503
+os.environ.setdefault("STREAM_MAX_PER_WORKER", str(max(1, worker_connections - 50)))
+# No preload: the gevent worker patches the standard library before it
+# imports the app, modules imported by the master would keep blocking sockets
+preload_app = False
+
+
+def post_worker_init(worker):
+    # Firestore talks gRPC, which needs its own gevent integration to yield
+    # instead of blocking the worker's event loop
+    from grpc.experimental import gevent as grpc_gevent
+    grpc_gevent.init_gevent()
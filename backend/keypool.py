@@ -0,0 +1,94 @@
+# ---- Pre-generated Kyber keypairs for registration ----
+#
+# A background thread keeps between KEYPOOL_LOW_WATERMARK and KEYPOOL_SIZE
+# fresh keypairs per worker process, generated KEYPOOL_BATCH at a time with
+# one library call. Secret keys wait in memory sealed with AES-GCM under a
+# random key that never leaves the process, and every keypair is handed out
+# exactly once. When the pool runs dry, registration generates inline.
+
+import os
+import threading
+from collections import deque
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from dotenv import load_dotenv
+from kyber import get_kyber
+
+load_dotenv()
+
+KEYPOOL_SIZE = int(os.getenv("KEYPOOL_SIZE", 32))
+KEYPOOL_LOW_WATERMARK = int(os.getenv("KEYPOOL_LOW_WATERMARK", 8))
+KEYPOOL_BATCH = int(os.getenv("KEYPOOL_BATCH", 8))
+KEYPOOL_ENABLED = os.getenv("KEYPOOL_ENABLED", "true").lower() in ("1", "true", "yes")
+
+
+class KeypairPool:
+    """Bounded pool of keypairs, refilled by a daemon thread below the low watermark."""
+
+    def __init__(self, size, low_watermark, batch, enabled=True):
+        self.size = size
+        self.low_watermark = min(low_watermark, size)
+        self.batch = max(1, batch)
+        self.enabled = enabled and size > 0
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Keypairs and the refill thread must not be shared with a forked child
+        self._keypairs = deque()
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()
+        self._thread = None
+        self._seal_key = AESGCM.generate_key(bit_length=256)
+
+    def start(self):
+        """Start the refill thread, also done lazily by the first take()."""
+        if not self.enabled or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._refill_loop, name="keypool", daemon=True)
+                self._thread.start()
+        self._wanted.set()
+
+    def take(self):
+        """Hex-encoded (public_key, private_key), from the pool when one is ready."""
+        self.start()
+        with self._lock:
+            sealed = self._keypairs.popleft() if self._keypairs else None
+            remaining = len(self._keypairs)
+        if remaining < self.low_watermark:
+            self._wanted.set()
+        if sealed is None:
+            public_key, private_key = get_kyber().generate_keypair()
+            return public_key, private_key
+        public_key, nonce, sealed_sk = sealed
+        return public_key.hex(), AESGCM(self._seal_key).decrypt(nonce, sealed_sk, public_key).hex()
+
+    def __len__(self):
+        return len(self._keypairs)
+
+    def _refill_loop(self):
+        while True:
+            self._wanted.wait()
+            self._wanted.clear()
+            try:
+                while len(self._keypairs) < self.size:
+                    self._refill(min(self.batch, self.size - len(self._keypairs)))
+            except Exception as e:
+                print(f"⚠️ Warning: Keypair pool refill failed: {e}")
+
+    def _refill(self, count):
+        public_keys, secret_keys = get_kyber().generate_keypairs(count)
+        aead = AESGCM(self._seal_key)
+        sealed = []
+        for pk, sk in zip(public_keys, secret_keys):
+            public_key = bytes(pk)
+            nonce = os.urandom(12)
+            # The public key is bound as associated data, pairs cannot be mixed up
+            sealed.append((public_key, nonce, aead.encrypt(nonce, bytes(sk), public_key)))
+            sk[:] = bytes(len(sk))
+        with self._lock:
+            self._keypairs.extend(sealed)
+
+
+keypair_pool = KeypairPool(KEYPOOL_SIZE, KEYPOOL_LOW_WATERMARK, KEYPOOL_BATCH, KEYPOOL_ENABLED)
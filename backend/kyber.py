@@ -1,10 +1,44 @@
 import os
 import platform
+import threading
 from ctypes import CDLL, c_ubyte, POINTER, c_int
 from dotenv import load_dotenv
+from metrics import timed
 
 load_dotenv()
 
+# The mock KEM is not secure, only fall back to it when explicitly allowed
+KYBER_ALLOW_MOCK = os.getenv("KYBER_ALLOW_MOCK", "false").lower() in ("1", "true", "yes")
+
+# Kyber-768 sizes in bytes
+PUBLICKEYBYTES = 1184
+SECRETKEYBYTES = 2400
+CIPHERTEXTBYTES = 1088
+SHAREDSECRETBYTES = 32
+
+
+def _as_c_buffer(data, item_size):
+    """Expose contiguous bytes-like data (or a list of items) as one ctypes array.
+
+    Writable buffers are shared without copying, read-only ones are copied once.
+    Returns the array and the number of items it holds.
+    """
+    if isinstance(data, (list, tuple)):
+        data = b"".join(data)
+    view = memoryview(data).cast("B")
+    if len(view) % item_size:
+        raise ValueError(f"Buffer length {len(view)} is not a multiple of {item_size}")
+    array_type = c_ubyte * len(view)
+    if view.readonly:
+        return array_type.from_buffer_copy(view), len(view) // item_size
+    return array_type.from_buffer(view), len(view) // item_size
+
+
+def _split(buf, item_size):
+    """Views of each item in a packed output buffer."""
+    view = memoryview(buf)
+    return [view[i:i + item_size] for i in range(0, len(buf), item_size)]
+
 
 class KyberWrapper:
     def __init__(self, lib_path=None):
@@ -43,52 +77,236 @@ class KyberWrapper:
             print(f"⚠️ Warning: Could not load Kyber library from {self.lib_path}: {e}")
             self.kyber = None
 
+        # Batch entry points, older builds of the library do not export them
+        self.has_batch = False
+        if self.kyber:
+            try:
+                self.kyber.my_crypto_kem_keypair_many.argtypes = [POINTER(c_ubyte), POINTER(c_ubyte), c_int]
+                self.kyber.my_crypto_kem_keypair_many.restype = c_int
+                self.kyber.my_crypto_kem_enc_many.argtypes = [
+                    POINTER(c_ubyte), POINTER(c_ubyte), POINTER(c_ubyte), c_int, c_int
+                ]
+                self.kyber.my_crypto_kem_enc_many.restype = c_int
+                self.kyber.my_crypto_kem_dec_many.argtypes = [
+                    POINTER(c_ubyte), POINTER(c_ubyte), POINTER(c_ubyte), c_int, c_int
+                ]
+                self.kyber.my_crypto_kem_dec_many.restype = c_int
+                self.has_batch = True
+            except AttributeError:
+                pass
+
+    @timed("kem.keygen")
     def generate_keypair(self):
         """Generate Kyber public/private keypair."""
         if not self.kyber:
             # Fallback mock (testing only)
-            pk = os.urandom(1184)
-            sk = os.urandom(2400)
+            pk = os.urandom(PUBLICKEYBYTES)
+            sk = os.urandom(SECRETKEYBYTES)
             print("⚠️ Warning: Using mock Kyber keypair generation.")
             return pk.hex(), sk.hex()
 
-        pk = (c_ubyte * 1184)()
-        sk = (c_ubyte * 2400)()
+        pk = (c_ubyte * PUBLICKEYBYTES)()
+        sk = (c_ubyte * SECRETKEYBYTES)()
 
         if self.kyber.my_crypto_kem_keypair(pk, sk) != 0:
             raise Exception("Kyber keypair generation failed")
 
         return bytes(pk).hex(), bytes(sk).hex()
 
+    @timed("kem.encapsulate")
     def encapsulate(self, pk_bytes):
         """Run Kyber encapsulation on given public key bytes."""
         if not self.kyber:
             # Fallback mock (testing only)
-            shared_secret = os.urandom(32)
-            ciphertext = os.urandom(1088)
+            shared_secret = os.urandom(SHAREDSECRETBYTES)
+            ciphertext = os.urandom(CIPHERTEXTBYTES)
             print("⚠️ Warning: Using mock Kyber keypair generation.")
             return ciphertext, shared_secret
 
-        pk = (c_ubyte * 1184).from_buffer_copy(pk_bytes)
-        ct = (c_ubyte * 1088)()
-        ss = (c_ubyte * 32)()
+        pk = (c_ubyte * PUBLICKEYBYTES).from_buffer_copy(pk_bytes)
+        ct = (c_ubyte * CIPHERTEXTBYTES)()
+        ss = (c_ubyte * SHAREDSECRETBYTES)()
 
         if self.kyber.my_crypto_kem_enc(ct, ss, pk) != 0:
             raise Exception("Kyber encapsulation failed")
 
         return bytes(ct), bytes(ss)
+    @timed("kem.decapsulate")
     def decapsulate(self, ct_bytes, sk_bytes):
         if not self.kyber:
         # fallback for testing
             print("⚠️ Warning: Using mock Kyber keypair generation.")
-            return os.urandom(32)
+            return os.urandom(SHAREDSECRETBYTES)
 
-        ct = (c_ubyte * 1088).from_buffer_copy(ct_bytes)
-        sk = (c_ubyte * 2400).from_buffer_copy(sk_bytes)
-        ss = (c_ubyte * 32)()
+        ct = (c_ubyte * CIPHERTEXTBYTES).from_buffer_copy(ct_bytes)
+        sk = (c_ubyte * SECRETKEYBYTES).from_buffer_copy(sk_bytes)
+        ss = (c_ubyte * SHAREDSECRETBYTES)()
 
         if self.kyber.my_crypto_kem_dec(ss, ct, sk) != 0:
             raise Exception("Kyber decapsulation failed")
 
             print("⚠️ Warning: Using mock Kyber keypair generation.")
-        return bytes(ss)
\ No newline at end of file
+        return bytes(ss)
+
+    def generate_keypairs(self, n):
+        """Generate `n` keypairs with one library call.
+
+        Returns lists of public and secret key views into two packed buffers.
+        Each keypair is recorded as one kem.keygen with its share of the time.
+        """
+        pk_buf = bytearray(n * PUBLICKEYBYTES)
+        sk_buf = bytearray(n * SECRETKEYBYTES)
+        if n == 0:
+            return [], []
+
+        with timed("kem.keygen", count=n):
+            if not self.kyber:
+                print("⚠️ Warning: Using mock Kyber keypair generation.")
+                pk_buf[:] = os.urandom(len(pk_buf))
+                sk_buf[:] = os.urandom(len(sk_buf))
+            elif self.has_batch:
+                pk, _ = _as_c_buffer(pk_buf, PUBLICKEYBYTES)
+                sk, _ = _as_c_buffer(sk_buf, SECRETKEYBYTES)
+                if self.kyber.my_crypto_kem_keypair_many(pk, sk, n) != 0:
+                    raise Exception("Kyber keypair generation failed")
+            else:
+                for i in range(n):
+                    pk = (c_ubyte * PUBLICKEYBYTES).from_buffer(pk_buf, i * PUBLICKEYBYTES)
+                    sk = (c_ubyte * SECRETKEYBYTES).from_buffer(sk_buf, i * SECRETKEYBYTES)
+                    if self.kyber.my_crypto_kem_keypair(pk, sk) != 0:
+                        raise Exception("Kyber keypair generation failed")
+                    del pk, sk
+
+        return _split(pk_buf, PUBLICKEYBYTES), _split(sk_buf, SECRETKEYBYTES)
+
+    def encapsulate_many(self, pks, n=None):
+        """Run encapsulation for every public key in a packed buffer.
+
+        Pass a single public key and `n` to encapsulate `n` times against it.
+        Returns lists of ciphertext and shared secret views.
+        """
+        pk, count = _as_c_buffer(pks, PUBLICKEYBYTES)
+        pk_stride = PUBLICKEYBYTES
+        if n is not None:
+            if count != 1:
+                raise ValueError("n can only be given together with a single public key")
+            count, pk_stride = n, 0
+
+        ct_buf = bytearray(count * CIPHERTEXTBYTES)
+        ss_buf = bytearray(count * SHAREDSECRETBYTES)
+        if count == 0:
+            return [], []
+
+        with timed("kem.encapsulate", count=count):
+            if not self.kyber:
+                print("⚠️ Warning: Using mock Kyber keypair generation.")
+                ct_buf[:] = os.urandom(len(ct_buf))
+                ss_buf[:] = os.urandom(len(ss_buf))
+            elif self.has_batch:
+                ct, _ = _as_c_buffer(ct_buf, CIPHERTEXTBYTES)
+                ss, _ = _as_c_buffer(ss_buf, SHAREDSECRETBYTES)
+                if self.kyber.my_crypto_kem_enc_many(ct, ss, pk, pk_stride, count) != 0:
+                    raise Exception("Kyber encapsulation failed")
+            else:
+                for i in range(count):
+                    ct = (c_ubyte * CIPHERTEXTBYTES).from_buffer(ct_buf, i * CIPHERTEXTBYTES)
+                    ss = (c_ubyte * SHAREDSECRETBYTES).from_buffer(ss_buf, i * SHAREDSECRETBYTES)
+                    pk_i = (c_ubyte * PUBLICKEYBYTES).from_buffer(pk, i * pk_stride)
+                    if self.kyber.my_crypto_kem_enc(ct, ss, pk_i) != 0:
+                        raise Exception("Kyber encapsulation failed")
+                    del ct, ss
+
+        return _split(ct_buf, CIPHERTEXTBYTES), _split(ss_buf, SHAREDSECRETBYTES)
+
+    def decapsulate_many(self, cts, sks):
+        """Run decapsulation for every ciphertext in a packed buffer.
+
+        `sks` is either one secret key shared by all ciphertexts or one
+        secret key per ciphertext. Returns a list of shared secret views.
+        """
+        ct, count = _as_c_buffer(cts, CIPHERTEXTBYTES)
+        sk, sk_count = _as_c_buffer(sks, SECRETKEYBYTES)
+        if sk_count == 1:
+            sk_stride = 0
+        elif sk_count == count:
+            sk_stride = SECRETKEYBYTES
+        else:
+            raise ValueError("Expected one secret key, or one per ciphertext")
+
+        ss_buf = bytearray(count * SHAREDSECRETBYTES)
+        if count == 0:
+            return []
+
+        with timed("kem.decapsulate", count=count):
+            if not self.kyber:
+                print("⚠️ Warning: Using mock Kyber keypair generation.")
+                ss_buf[:] = os.urandom(len(ss_buf))
+            elif self.has_batch:
+                ss, _ = _as_c_buffer(ss_buf, SHAREDSECRETBYTES)
+                if self.kyber.my_crypto_kem_dec_many(ss, ct, sk, sk_stride, count) != 0:
+                    raise Exception("Kyber decapsulation failed")
+            else:
+                for i in range(count):
+                    ss = (c_ubyte * SHAREDSECRETBYTES).from_buffer(ss_buf, i * SHAREDSECRETBYTES)
+                    ct_i = (c_ubyte * CIPHERTEXTBYTES).from_buffer(ct, i * CIPHERTEXTBYTES)
+                    sk_i = (c_ubyte * SECRETKEYBYTES).from_buffer(sk, i * sk_stride)
+                    if self.kyber.my_crypto_kem_dec(ss, ct_i, sk_i) != 0:
+                        raise Exception("Kyber decapsulation failed")
+                    del ss
+
+        return _split(ss_buf, SHAREDSECRETBYTES)
+
+
+# ---- Process-wide instance ----
+
+_instance = None
+_instance_lock = threading.Lock()
+
+
+def _reset_lock_after_fork():
+    # The loaded library stays valid in a forked child, a held lock would not
+    global _instance_lock
+    _instance_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+
+def _load():
+    global _instance
+    if _instance is None:
+        with _instance_lock:
+            if _instance is None:
+                _instance = KyberWrapper()
+    return _instance
+
+
+def get_kyber():
+    """Shared KyberWrapper, the library is loaded once per process on first use."""
+    wrapper = _load()
+    if not wrapper.kyber and not KYBER_ALLOW_MOCK:
+        raise RuntimeError(
+            f"Kyber library could not be loaded from {wrapper.lib_path}; "
+            "set KYBER_ALLOW_MOCK=true to use the insecure mock (testing only)"
+        )
+    return wrapper
+
+
+def preload():
+    """Load the library ahead of the first request, e.g. from a gunicorn hook."""
+    wrapper = _load()
+    if wrapper.kyber:
+        print(f"Kyber library loaded from {wrapper.lib_path}")
+    return wrapper
+
+
+def health():
+    """Report whether the real library or the mock fallback is active."""
+    wrapper = _load()
+    return {
+        "library": "real" if wrapper.kyber else "mock",
+        "lib_path": wrapper.lib_path,
+        "batch": wrapper.has_batch,
+        "mock_allowed": KYBER_ALLOW_MOCK,
+        "ok": bool(wrapper.kyber) or KYBER_ALLOW_MOCK,
+    }
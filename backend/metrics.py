@@ -0,0 +1,326 @@
+# ---- Latency metrics: Prometheus histograms and Server-Timing ----
+#
+# timed("phase") wraps a block or function and records its duration in the
+# phase histogram. Inside a request the time is also added to that request's
+# totals, which after_request sends back as a Server-Timing header. The
+# totals live in a context variable, and BoundedPool runs jobs in a copy of
+# the caller's context, so work done on pool threads is counted for the
+# request that submitted it. Phases may nest: unwrapping a key includes the
+# KEM decapsulation inside it.
+#
+# Metrics are kept per process. When METRICS_DIR is set (gunicorn.conf.py
+# sets a default), every process also writes its histograms to
+# METRICS_DIR/<pid>.json at most every METRICS_SYNC_INTERVAL seconds, and
+# /metrics adds up the files of all workers, so a scrape covers the whole
+# server whichever worker answers it. Files of exited workers keep counting,
+# as counters must not go down; gunicorn empties the directory on start.
+
+import contextvars
+import functools
+import glob
+import hmac
+import json
+import os
+import threading
+import time
+from dotenv import load_dotenv
+from flask import Response, g, request
+
+load_dotenv()
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "true").lower() in ("1", "true", "yes")
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+METRICS_DIR = os.getenv("METRICS_DIR")
+METRICS_SYNC_INTERVAL = float(os.getenv("METRICS_SYNC_INTERVAL", 1))
+
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+_request_phases = contextvars.ContextVar("request_phases", default=None)
+
+
+class Histogram:
+    """Cumulative bucket counts for one label set."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value, count=1):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += count
+                break
+        self.count += count
+        self.sum += value * count
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+        yield f'{name}_bucket{{{labels},le="+Inf"}} {self.count}'
+        yield f"{name}_sum{{{labels}}} {self.sum}"
+        yield f"{name}_count{{{labels}}} {self.count}"
+
+
+class HistogramFamily:
+    """Histograms of one metric, keyed by label values."""
+
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values, count=1):
+        with self._lock:
+            histogram = self._histograms.get(label_values)
+            if histogram is None:
+                histogram = self._histograms[label_values] = Histogram()
+            histogram.observe(value, count)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    def snapshot(self):
+        """JSON-ready state, merged back with merge()."""
+        with self._lock:
+            return [
+                [list(label_values), list(histogram.counts), histogram.count, histogram.sum]
+                for label_values, histogram in self._histograms.items()
+            ]
+
+    def merge(self, snapshot):
+        with self._lock:
+            for label_values, counts, count, total in snapshot:
+                histogram = self._histograms.setdefault(tuple(label_values), Histogram())
+                histogram.counts = [a + b for a, b in zip(histogram.counts, counts)]
+                histogram.count += count
+                histogram.sum += total
+
+    def total(self):
+        with self._lock:
+            return sum(histogram.count for histogram in self._histograms.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for label_values, histogram in sorted(self._histograms.items()):
+                labels = ",".join(
+                    f'{name}="{_escape(value)}"' for name, value in zip(self.label_names, label_values)
+                )
+                lines.extend(histogram.lines(self.name, labels))
+        return lines
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+phase_seconds = HistogramFamily(
+    "pqmessenger_phase_duration_seconds", "Time spent in one phase of request handling.", ("phase",)
+)
+request_seconds = HistogramFamily(
+    "pqmessenger_request_duration_seconds", "Time to produce a response, streamed bodies excluded.",
+    ("endpoint", "method", "status"),
+)
+
+
+class _RequestPhases:
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, phase, seconds):
+        with self.lock:
+            self.totals[phase] = self.totals.get(phase, 0.0) + seconds
+
+
+_FAMILIES = (phase_seconds, request_seconds)
+
+
+def record(phase, seconds, count=1):
+    """Add a phase duration; `count` operations done in one call share it evenly."""
+    phase_seconds.observe(seconds / count, phase, count=count)
+    phases = _request_phases.get()
+    if phases is not None:
+        phases.add(phase, seconds)
+
+
+class timed:
+    """Time a block (`with timed("aes"):`) or every call of a function (`@timed("aes")`).
+
+    `count` is the number of operations a batched block performs, each is
+    recorded with its share of the time.
+    """
+
+    def __init__(self, phase, count=1):
+        self.phase = phase
+        self.count = count
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        if METRICS_ENABLED and self.count:
+            record(self.phase, time.perf_counter() - self._start, self.count)
+        return False
+
+    def __call__(self, fn):
+        phase = self.phase
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not METRICS_ENABLED:
+                return fn(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                record(phase, time.perf_counter() - start)
+        return wrapper
+
+
+def timed_iter(phase, iterable):
+    """Yield from `iterable`, timing only the work of producing each item."""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            if METRICS_ENABLED:
+                record(phase, time.perf_counter() - start)
+            return
+        if METRICS_ENABLED:
+            record(phase, time.perf_counter() - start)
+        yield item
+
+
+class _Sync:
+    """Writes this process's snapshot file to METRICS_DIR from a background thread."""
+
+    def __init__(self):
+        self._reset()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def _reset(self):
+        self._thread = None
+        self._lock = threading.Lock()
+        self._written = None
+        self.path = os.path.join(METRICS_DIR, f"{os.getpid()}.json") if METRICS_DIR else None
+
+    def _after_fork(self):
+        # A forked worker reports only what it records itself
+        for family in _FAMILIES:
+            family.reset()
+        self._reset()
+
+    def start(self):
+        if self.path is None or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="metrics-sync", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(METRICS_SYNC_INTERVAL)
+            try:
+                self.write()
+            except OSError as e:
+                print(f"⚠️ Warning: Could not write metrics to {self.path}: {e}")
+
+    def write(self):
+        """Replace the snapshot file if anything was recorded since the last write."""
+        with self._lock:
+            written = tuple(family.total() for family in _FAMILIES)
+            if written == self._written:
+                return
+            snapshot = {family.name: family.snapshot() for family in _FAMILIES}
+            os.makedirs(METRICS_DIR, exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_path, self.path)
+            self._written = written
+
+
+_sync = _Sync()
+
+
+def clear_dir():
+    """Remove every snapshot in METRICS_DIR, for the server to start from zero."""
+    if METRICS_DIR:
+        for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+            os.remove(path)
+
+
+def _merged_families():
+    families = [HistogramFamily(family.name, family.help_text, family.label_names) for family in _FAMILIES]
+    for path in glob.glob(os.path.join(METRICS_DIR, "*.json")):
+        try:
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            continue
+        for family in families:
+            family.merge(snapshot.get(family.name, []))
+    return families
+
+
+def render():
+    """All metrics in the Prometheus text exposition format.
+
+    With METRICS_DIR, the sum over every process that wrote a snapshot.
+    """
+    families = _FAMILIES
+    if _sync.path is not None:
+        _sync.write()
+        families = _merged_families()
+    lines = [line for family in families for line in family.render()]
+    return "\n".join(lines) + "\n"
+
+
+def init_app(app):
+    """Record request latencies, add Server-Timing headers and serve /metrics."""
+    if not METRICS_ENABLED:
+        return
+
+    @app.before_request
+    def _start_timing():
+        _sync.start()
+        g.request_started = time.perf_counter()
+        _request_phases.set(_RequestPhases())
+
+    @app.after_request
+    def _finish_timing(response):
+        started = g.get("request_started")
+        phases = _request_phases.get()
+        if started is None or phases is None:
+            return response
+        elapsed = time.perf_counter() - started
+        request_seconds.observe(elapsed, request.endpoint or "unmatched", request.method, str(response.status_code))
+
+        with phases.lock:
+            totals = sorted(phases.totals.items())
+        entries = [f"{phase};dur={seconds * 1000:.2f}" for phase, seconds in totals]
+        entries.append(f"total;dur={elapsed * 1000:.2f}")
+        response.headers["Server-Timing"] = ", ".join(entries)
+        return response
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        # Fail closed, latencies and route names are not for the public
+        if not METRICS_TOKEN:
+            return Response("Set METRICS_TOKEN to enable /metrics\n", status=403, mimetype="text/plain")
+        supplied = request.headers.get("Authorization", "").removeprefix("Bearer ")
+        if not hmac.compare_digest(supplied, METRICS_TOKEN):
+            return Response("Unauthorized\n", status=401, mimetype="text/plain")
+        return Response(render(), mimetype="text/plain; version=0.0.4")
@@ -0,0 +1,93 @@
+# Rewrites message documents that still carry their own copy of the KEM
+# wraps (legacy hex fields, or a version 1 binary envelope) into the layout
+# written by chat_message: a version 2 payload envelope that references a
+# shared document in the key_envelopes collection.
+#
+# Usage: python migrate_messages.py [--dry-run] [--batch-size 200]
+
+import argparse
+from datetime import datetime, timezone
+from firebase_admin import firestore
+from envelope import (
+    ENVELOPE_V2,
+    ENVELOPE_V3,
+    MESSAGE_FIELDS,
+    key_wrap_id,
+    pack_key_wrap,
+    pack_payload,
+    read_message_fields,
+    unpack_fields,
+)
+from firebase_init import init_firestore
+
+
+def _needs_migration(data):
+    blob = data.get("envelope")
+    if blob is None:
+        return "message" in data
+    version, _ = unpack_fields(blob)
+    return version not in (ENVELOPE_V2, ENVELOPE_V3)
+
+
+def migrate(db, batch_size=200, dry_run=False):
+    """Convert every message with inline wraps, returns (migrated, skipped) counts."""
+    migrated = skipped = 0
+    messages_ref = db.collection("messages")
+    envelopes_ref = db.collection("key_envelopes")
+    written_envelopes = set()
+    last_doc = None
+
+    # Page through the collection so no single stream stays open for long.
+    # A page writes at most two documents per message, within the 500 limit.
+    while True:
+        query = messages_ref.order_by("__name__").limit(batch_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+
+        batch = db.batch()
+        pending = 0
+        for doc in docs:
+            data = doc.to_dict()
+            if not _needs_migration(data):
+                skipped += 1
+                continue
+
+            fields = read_message_fields(data)
+            wrap = pack_key_wrap(fields)
+            envelope_id = key_wrap_id(wrap)
+            if envelope_id not in written_envelopes:
+                batch.set(envelopes_ref.document(envelope_id), {
+                    "from": data.get("from"),
+                    "to": data.get("to"),
+                    "wrap": wrap,
+                    "created_at": datetime.now(timezone.utc).isoformat(),
+                })
+                written_envelopes.add(envelope_id)
+
+            update = {name: firestore.DELETE_FIELD for name in MESSAGE_FIELDS if name in data}
+            update["envelope_id"] = envelope_id
+            update["envelope"] = pack_payload(fields["message"], fields["iv_message"])
+            batch.update(doc.reference, update)
+            pending += 1
+
+        if pending and not dry_run:
+            batch.commit()
+        migrated += pending
+        print(f"Processed {migrated + skipped} messages ({migrated} converted)")
+
+    return migrated, skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move inline message key wraps into shared key envelopes")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    parser.add_argument("--batch-size", type=int, default=200, help="messages per page and write batch (max 250)")
+    args = parser.parse_args()
+
+    migrated, skipped = migrate(init_firestore(), batch_size=min(args.batch_size, 250), dry_run=args.dry_run)
+    action = "Would convert" if args.dry_run else "Converted"
+    print(f"{action} {migrated} messages, {skipped} already up to date")
@@ -0,0 +1,86 @@
+# Moves the notifications array of user documents written by older versions
+# into the users/{user_id}/notifications subcollection and removes the array.
+# Only the newest NOTIFICATIONS_MAX entries within the retention period are
+# kept, counting those already in the subcollection. Safe to re-run: users
+# without the array are skipped.
+#
+# Usage: python migrate_notifications.py [--dry-run] [--batch-size 100]
+
+import argparse
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from firebase_init import init_firestore
+from models.notification import Notification, NOTIFICATIONS_MAX, NOTIFICATIONS_RETENTION_DAYS
+
+# Firestore allows 500 writes per batch, one is the array removal
+WRITES_PER_BATCH = 400
+
+
+def _parse_time(value):
+    try:
+        time = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        return None
+    # Old entries were written with utcnow(), without a zone
+    return time if time.tzinfo else time.replace(tzinfo=timezone.utc)
+
+
+def migrate(db, batch_size=100, dry_run=False):
+    """Move legacy notification arrays, returns (users migrated, notifications moved)."""
+    users_migrated = moved = 0
+    users_ref = db.collection("users")
+    cutoff = datetime.now(timezone.utc) - timedelta(days=NOTIFICATIONS_RETENTION_DAYS)
+    last_doc = None
+
+    while True:
+        query = users_ref.order_by("__name__").limit(batch_size)
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = list(query.stream())
+        if not docs:
+            break
+        last_doc = docs[-1]
+
+        for doc in docs:
+            legacy = (doc.to_dict() or {}).get("notifications")
+            if legacy is None:
+                continue
+
+            entries = []
+            for index, entry in enumerate(legacy):
+                time = _parse_time(entry.get("time"))
+                if time is not None and time >= cutoff:
+                    entries.append((time, index, entry))
+            entries.sort(key=lambda item: item[:2])
+            entries = entries[-NOTIFICATIONS_MAX:]
+
+            if not dry_run:
+                for start in range(0, len(entries), WRITES_PER_BATCH):
+                    batch = db.batch()
+                    for time, index, entry in entries[start:start + WRITES_PER_BATCH]:
+                        Notification.add(
+                            batch, db, doc.id, entry.get("username", "Unknown"), entry.get("type"),
+                            now=time, notification_id=f"legacy-{index:06d}",
+                        )
+                    batch.commit()
+                # Dropped last, an interrupted run rewrites the same documents
+                doc.reference.update({"notifications": firestore.DELETE_FIELD})
+                # Notifications added since the upgrade count towards the cap too
+                Notification.trim(db, doc.id)
+
+            users_migrated += 1
+            moved += len(entries)
+            print(f"Migrated {len(entries)} of {len(legacy)} notifications for user {doc.id}")
+
+    return users_migrated, moved
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Move notification arrays into per-user subcollections")
+    parser.add_argument("--dry-run", action="store_true", help="report what would change without writing")
+    parser.add_argument("--batch-size", type=int, default=100, help="users read per page")
+    args = parser.parse_args()
+
+    users_migrated, moved = migrate(init_firestore(), batch_size=args.batch_size, dry_run=args.dry_run)
+    action = "Would move" if args.dry_run else "Moved"
+    print(f"{action} {moved} notifications of {users_migrated} users")
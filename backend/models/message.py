@@ -0,0 +1,112 @@
+import heapq
+import itertools
+from firebase_admin import firestore
+from metrics import timed, timed_iter
+
+
+class InvalidPageToken(ValueError):
+    """Raised when a page token does not name a message of the conversation."""
+
+
+class Message:
+    """Queries over the messages collection.
+
+    Every message carries `conversation_id`, the same for both directions of
+    a chat, and `sent_at`, a server timestamp. Pages are read with queries
+    served by the composite indexes in firestore.indexes.json.
+    """
+
+    @staticmethod
+    def conversation_id(user_a, user_b):
+        """Canonical id of the conversation between two users."""
+        return "_".join(sorted([user_a, user_b]))
+
+    @staticmethod
+    def page(db, conversation_id, limit, before=None, after=None, sent_at=None, queued=()):
+        """One page of a conversation, oldest message first.
+
+        `after` and `before` are message ids used as page tokens: the page
+        holds the oldest messages after `after`, the newest ones before
+        `before`, or the latest messages when neither is given. With the
+        token's `sent_at` the token is not looked up, so it may name a
+        message that is still queued. `queued` lists (message_id, data) of
+        messages not written yet, oldest first, which are merged into the page.
+        Returns a list of (message_id, data).
+        """
+        return list(Message.iter_page(
+            db, conversation_id, limit, before=before, after=after, sent_at=sent_at, queued=queued
+        ))
+
+    @staticmethod
+    def iter_page(db, conversation_id, limit, before=None, after=None, sent_at=None, queued=()):
+        """Iterator version of page(), which streams the page in order.
+
+        The page token is checked before returning. Pages that end at the
+        latest message or at `before` first find their oldest message with a
+        descending query that only reads `sent_at`, then stream forward from it.
+        """
+        messages_ref = db.collection("messages")
+        query = messages_ref.where("conversation_id", "==", conversation_id)
+        token = after or before
+        cursor = None
+        if token:
+            cursor = Message._cursor(messages_ref, conversation_id, token, sent_at, queued)
+            if after:
+                queued = [item for item in queued if _key(item) > cursor]
+            else:
+                queued = [item for item in queued if _key(item) < cursor]
+
+        forward = query.order_by("sent_at").order_by("__name__")
+        if after:
+            forward = forward.start_after(_cursor_values(cursor))
+        else:
+            backward = query.order_by("sent_at", direction=firestore.Query.DESCENDING).order_by(
+                "__name__", direction=firestore.Query.DESCENDING
+            )
+            if cursor:
+                backward = backward.start_after(_cursor_values(cursor))
+            keys = [
+                (snap.get("sent_at"), snap.id)
+                for snap in timed_iter("firestore.read", backward.limit(limit).select(["sent_at"]).stream())
+            ]
+            keys = heapq.nlargest(limit, set(keys).union(map(_key, queued)))
+            if not keys:
+                return iter(())
+            first = keys[-1]
+            forward = forward.start_at(_cursor_values(first))
+            queued = [item for item in queued if _key(item) >= first]
+            if cursor:
+                forward = forward.end_before(_cursor_values(cursor))
+
+        docs = ((doc.id, doc.to_dict()) for doc in timed_iter("firestore.read", forward.limit(limit).stream()))
+        if not queued:
+            return docs
+        # A message flushed while the page was read shows up on both sides
+        merged = heapq.merge(docs, queued, key=_key)
+        unique = (next(group) for _, group in itertools.groupby(merged, key=lambda item: item[0]))
+        return itertools.islice(unique, limit)
+
+    @staticmethod
+    def _cursor(messages_ref, conversation_id, token, sent_at, queued):
+        """(sent_at, message_id) of a page token."""
+        if sent_at is not None:
+            return (sent_at, token)
+        for message_id, data in queued:
+            if message_id == token:
+                return _key((message_id, data))
+        with timed("firestore.read"):
+            snap = messages_ref.document(token).get()
+        data = snap.to_dict() or {}
+        if not snap.exists or data.get("conversation_id") != conversation_id or "sent_at" not in data:
+            raise InvalidPageToken(f"Unknown page token {token}")
+        return (data["sent_at"], token)
+
+
+def _key(item):
+    message_id, data = item
+    return (data["sent_at"], message_id)
+
+
+def _cursor_values(key):
+    sent_at, message_id = key
+    return {"sent_at": sent_at, "__name__": message_id}
@@ -0,0 +1,111 @@
+import os
+from datetime import datetime, timedelta, timezone
+from firebase_admin import firestore
+from metrics import timed, timed_iter
+
+# Oldest notifications beyond this many per user are deleted when a new one is added
+NOTIFICATIONS_MAX = int(os.getenv("NOTIFICATIONS_MAX", 200))
+# Firestore's TTL policy on expire_at deletes notifications older than this
+NOTIFICATIONS_RETENTION_DAYS = int(os.getenv("NOTIFICATIONS_RETENTION_DAYS", 90))
+
+
+class InvalidNotificationToken(ValueError):
+    """Raised when a page token does not name a notification of the user."""
+
+
+class Notification:
+    """Notifications in the users/{user_id}/notifications subcollection.
+
+    Each document holds the sender's username, the type ("accept" or
+    "decline"), the ISO `time` shown to clients, a server `created_at` that
+    orders the list, a `read` marker and the `expire_at` TTL field, so the
+    user document stays small however many arrive.
+    """
+
+    @staticmethod
+    def collection(db, user_id):
+        return db.collection("users").document(user_id).collection("notifications")
+
+    @staticmethod
+    def add(batch, db, user_id, username, kind, now=None, notification_id=None):
+        """Queue a new notification for `user_id` on a write batch, returns its id.
+
+        `now` backdates the notification and `notification_id` makes the
+        write repeatable, e.g. when migrating old ones.
+        """
+        created_at = firestore.SERVER_TIMESTAMP if now is None else now
+        now = now or datetime.now(timezone.utc)
+        ref = Notification.collection(db, user_id).document(notification_id)
+        batch.set(ref, {
+            "username": username,
+            "type": kind,
+            "time": now.replace(tzinfo=None).isoformat(),
+            "created_at": created_at,
+            "expire_at": now + timedelta(days=NOTIFICATIONS_RETENTION_DAYS),
+            "read": False,
+        })
+        return ref.id
+
+    @staticmethod
+    def page(db, user_id, limit, before=None):
+        """Newest notifications first, older than the notification id `before` if given.
+
+        Returns a list of client dicts with id, username, type, time and read.
+        """
+        notifications_ref = Notification.collection(db, user_id)
+        query = notifications_ref.order_by("created_at", direction=firestore.Query.DESCENDING).order_by(
+            "__name__", direction=firestore.Query.DESCENDING
+        )
+        if before:
+            with timed("firestore.read"):
+                cursor = notifications_ref.document(before).get()
+            if not cursor.exists:
+                raise InvalidNotificationToken(f"Unknown page token {before}")
+            query = query.start_after(cursor)
+
+        notifications = []
+        for doc in timed_iter("firestore.read", query.limit(limit).stream()):
+            data = doc.to_dict()
+            notifications.append({
+                "id": doc.id,
+                "username": data.get("username"),
+                "type": data.get("type"),
+                "time": data.get("time"),
+                "read": data.get("read", False),
+            })
+        return notifications
+
+    @staticmethod
+    def mark_read(db, user_id, notification_ids):
+        """Set the read marker on the given notifications, returns how many were updated."""
+        notifications_ref = Notification.collection(db, user_id)
+        refs = [notifications_ref.document(notification_id) for notification_id in dict.fromkeys(notification_ids)]
+        batch = db.batch()
+        updated = 0
+        # Only existing ones, an update of a missing document fails the batch
+        for snap in timed_iter("firestore.read", db.get_all(refs, field_paths=["read"])):
+            if snap.exists and not (snap.to_dict() or {}).get("read"):
+                batch.update(snap.reference, {"read": True})
+                updated += 1
+        if updated:
+            with timed("firestore.write"):
+                batch.commit()
+        return updated
+
+    @staticmethod
+    def trim(db, user_id):
+        """Delete the oldest notifications beyond NOTIFICATIONS_MAX, returns how many went."""
+        notifications_ref = Notification.collection(db, user_id)
+        with timed("firestore.read"):
+            count = notifications_ref.count().get()[0][0].value
+        excess = min(count - NOTIFICATIONS_MAX, 500)
+        if excess <= 0:
+            return 0
+
+        oldest = notifications_ref.order_by("created_at").limit(excess).select(["__name__"])
+        batch = db.batch()
+        for doc in timed_iter("firestore.read", oldest.stream()):
+            batch.delete(doc.reference)
+        with timed("firestore.write"):
+            batch.commit()
+        return excess
@@ -1,5 +1,31 @@
+import os
+import json
 from datetime import datetime
 from firebase_admin import firestore
+from cache import TTLCache
+from metrics import timed, timed_iter
+
+# Firestore accepts large batched reads, keep each round trip moderate
+GET_ALL_CHUNK_SIZE = 100
+USERNAME_CACHE_SIZE = int(os.getenv("USERNAME_CACHE_SIZE", 10000))
+USERNAME_CACHE_TTL = int(os.getenv("USERNAME_CACHE_TTL", 600))
+
+PROFILE_CACHE_TTL = int(os.getenv("PROFILE_CACHE_TTL", 300))
+# A write leaves this marker in place of the cached profile, so a read that
+# started before the write cannot cache what it read
+PROFILE_INVALIDATION_TTL = int(os.getenv("PROFILE_INVALIDATION_TTL", 10))
+_INVALIDATED = "invalidated"
+
+# user id -> username, usernames never change once registered
+_username_cache = TTLCache(maxsize=USERNAME_CACHE_SIZE, ttl=USERNAME_CACHE_TTL)
+
+# Fields safe to cache; password hash and encrypted secret key material are
+# always read straight from Firestore
+PUBLIC_FIELDS = ('username', 'public_key', 'created_at', 'friends', 'pending_request_from', 'profilePic')
+
+
+def _profile_key(user_id):
+    return f"user:{user_id}:profile"
 
 class User:
     def __init__(self, username=None, password_hash=None, public_key=None, 
@@ -40,31 +66,141 @@ class User:
         return user
     
     @staticmethod
-    def get_by_username(db, username):
-        """Get user by username"""
+    def get_by_username(db, username, index=None):
+        """Get user by username, resolved through the username index when given"""
+        if index is not None:
+            user_id = index.lookup(username)
+            if user_id:
+                user = User.get_by_id(db, user_id)
+                if user and user.username == username:
+                    return user
+            elif not index.might_exist(username):
+                return None
+
         users_ref = db.collection('users')
         query = users_ref.where('username', '==', username).limit(1)
-        docs = query.stream()
+        docs = timed_iter("firestore.read", query.stream())
         for doc in docs:
+            if index is not None:
+                index.add(username, doc.id)
             return User.from_dict(doc.to_dict(), doc.id)
         return None
-    
+
+    @staticmethod
+    def username_taken(db, username, index=None):
+        """Whether a user already has this name; free names usually skip Firestore."""
+        if index is not None:
+            if not index.might_exist(username):
+                return False
+            if index.lookup(username):
+                return True
+
+        query = db.collection('users').where('username', '==', username).limit(1).select(['username'])
+        for doc in timed_iter("firestore.read", query.stream()):
+            if index is not None:
+                index.add(username, doc.id)
+            return True
+        return False
+
     @staticmethod
     def get_by_id(db, user_id):
         """Get user by ID"""
-        doc = db.collection('users').document(user_id).get()
+        with timed("firestore.read"):
+            doc = db.collection('users').document(user_id).get()
         if doc.exists:
             return User.from_dict(doc.to_dict(), doc.id)
         return None
     
-    def save(self, db):
-        """Save user to Firestore"""
+    @staticmethod
+    def get_usernames(db, user_ids):
+        """Map user ids to usernames, skipping users that do not exist.
+
+        Uncached ids are fetched with chunked get_all calls that only
+        read the username field.
+        """
+        usernames = {}
+        missing = []
+        for user_id in dict.fromkeys(user_ids):
+            username = _username_cache.get(user_id)
+            if username is None:
+                missing.append(user_id)
+            else:
+                usernames[user_id] = username
+
+        users_ref = db.collection('users')
+        for start in range(0, len(missing), GET_ALL_CHUNK_SIZE):
+            refs = [users_ref.document(user_id) for user_id in missing[start:start + GET_ALL_CHUNK_SIZE]]
+            for doc in timed_iter("firestore.read", db.get_all(refs, field_paths=['username'])):
+                if doc.exists:
+                    username = (doc.to_dict() or {}).get('username', 'Unknown')
+                    usernames[doc.id] = username
+                    _username_cache.set(doc.id, username)
+        return usernames
+
+    @staticmethod
+    def get_fields(db, user_ids, field_paths, transaction=None):
+        """Fields of several users read straight from Firestore, never from the cache.
+
+        Returns {user_id: dict} without the users that do not exist. Checks
+        that guard a write read inside its `transaction`.
+        """
+        users_ref = db.collection('users')
+        refs = [users_ref.document(user_id) for user_id in dict.fromkeys(user_ids)]
+        docs = db.get_all(refs, field_paths=field_paths, transaction=transaction)
+        return {doc.id: doc.to_dict() or {} for doc in timed_iter("firestore.read", docs) if doc.exists}
+
+    @staticmethod
+    def get_profile(db, cache, user_id):
+        """Public projection of a user document, read through the shared session store.
+
+        Returns a dict of PUBLIC_FIELDS (created_at as an ISO string), or None
+        if the user does not exist. Cached profiles may lag writes by a few
+        seconds, so checks that guard a write use get_fields instead.
+        """
+        cached = cache.get(_profile_key(user_id))
+        if cached and cached != _INVALIDATED:
+            return json.loads(cached)
+
+        with timed("firestore.read"):
+            doc = db.collection('users').document(user_id).get(field_paths=list(PUBLIC_FIELDS))
+        if not doc.exists:
+            return None
+
+        data = doc.to_dict()
+        created_at = data.get('created_at')
+        profile = {
+            'id': user_id,
+            'username': data.get('username'),
+            'public_key': data.get('public_key'),
+            'created_at': created_at.isoformat() if created_at else None,
+            'friends': data.get('friends', []),
+            'pending_request_from': data.get('pending_request_from', []),
+            'profilePic': data.get('profilePic'),
+        }
+        # Only fill an empty slot, a recent write's marker stays until it expires
+        if cached is None:
+            cache.set(_profile_key(user_id), json.dumps(profile), ex=PROFILE_CACHE_TTL, nx=True)
+        return profile
+
+    @staticmethod
+    def invalidate(cache, *user_ids):
+        """Drop cached profiles, call after every write to these user documents."""
+        for user_id in dict.fromkeys(user_ids):
+            cache.set(_profile_key(user_id), _INVALIDATED, ex=PROFILE_INVALIDATION_TTL)
+
+    @timed("firestore.write")
+    def save(self, db, cache=None, index=None):
+        """Save user to Firestore, adding new users to the username index if given"""
         users_ref = db.collection('users')
         if self.id:
             # Update existing user
             users_ref.document(self.id).set(self.to_dict())
+            if cache is not None:
+                User.invalidate(cache, self.id)
         else:
             # Create new user
             doc_ref = users_ref.add(self.to_dict())
             self.id = doc_ref[1].id
+            if index is not None:
+                index.add(self.username, self.id)
         return self.id
\ No newline at end of file
@@ -0,0 +1,329 @@
+# ---- Write-behind queue for new chat messages ----
+#
+# chat_message appends the message document to the Redis Stream
+# outbox:messages and answers as soon as Redis has it. A flusher thread in
+# every worker process reads the stream through one consumer group and
+# writes queued messages to Firestore in WriteBatch commits of up to
+# OUTBOX_BATCH_SIZE documents, collecting for OUTBOX_FLUSH_WINDOW_MS after
+# the first one arrives. Entries are acknowledged and deleted only after
+# their batch committed; a failed commit is retried from the pending list,
+# and entries left pending by a dead worker are claimed by another one
+# after OUTBOX_CLAIM_IDLE_MS.
+#
+# When a batch fails for any reason other than Firestore being unavailable,
+# its entries are written one at a time, so one bad message cannot hold back
+# the rest. A message that still fails after OUTBOX_MAX_DELIVERIES
+# deliveries (the consumer group's XPENDING count) is moved to the
+# outbox:messages:dead stream together with the error.
+#
+# Document ids and sent_at are derived from the stream entry id, so a
+# retried write overwrites the same document, and messages of one
+# conversation sort in send order. Every entry id is also added to the
+# sorted set outbox:conv:<conversation id> when it is queued and removed
+# when it leaves the stream. get_messages looks up the queued entries of
+# its conversation and time window there and merges them into its pages,
+# so a message can be read, and used as a page token, at its final position
+# as soon as it is queued. Queued messages are as durable as the Redis
+# persistence settings (use appendonly yes).
+
+import base64
+import hashlib
+import json
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timezone
+from dotenv import load_dotenv
+from google.api_core import exceptions
+import redis
+from metrics import timed
+
+load_dotenv()
+
+OUTBOX_ENABLED = os.getenv("OUTBOX_ENABLED", "true").lower() in ("1", "true", "yes")
+# One message is one write, Firestore allows 500 per batch
+OUTBOX_BATCH_SIZE = min(int(os.getenv("OUTBOX_BATCH_SIZE", 200)), 500)
+OUTBOX_FLUSH_WINDOW_MS = int(os.getenv("OUTBOX_FLUSH_WINDOW_MS", 20))
+OUTBOX_CLAIM_IDLE_MS = int(os.getenv("OUTBOX_CLAIM_IDLE_MS", 30000))
+OUTBOX_MAX_BACKOFF = float(os.getenv("OUTBOX_MAX_BACKOFF", 30))
+OUTBOX_MAX_DELIVERIES = int(os.getenv("OUTBOX_MAX_DELIVERIES", 5))
+
+OUTBOX_STREAM = "outbox:messages"
+OUTBOX_GROUP = "firestore"
+OUTBOX_DEAD_STREAM = "outbox:messages:dead"
+
+# Append a message and index its entry id under its conversation, in one step
+_ENQUEUE = """
+local entry_id = redis.call('XADD', KEYS[1], '*', 'conversation_id', ARGV[1], 'message', ARGV[2])
+redis.call('ZADD', KEYS[2], tonumber(string.match(entry_id, '^%d+')), entry_id)
+return entry_id
+"""
+
+# Firestore or the network being down, as opposed to a message it rejects
+_TRANSIENT_ERRORS = (
+    ConnectionError,
+    TimeoutError,
+    exceptions.Aborted,
+    exceptions.DeadlineExceeded,
+    exceptions.InternalServerError,
+    exceptions.ServiceUnavailable,
+    exceptions.TooManyRequests,
+)
+
+
+def message_id(entry_id, conversation_id):
+    """Firestore id of a queued message, the same for every retry.
+
+    The conversation prefix spreads writes across the key space, and within
+    a conversation ids sort like the stream entries.
+    """
+    millis, seq = entry_id.split("-")
+    prefix = hashlib.sha256(conversation_id.encode()).hexdigest()[:8]
+    return f"{prefix}-{int(millis):013d}-{int(seq):06d}"
+
+
+def conversation_key(conversation_id):
+    """Sorted set of a conversation's queued entry ids, scored by their millisecond time."""
+    return f"outbox:conv:{conversation_id}"
+
+
+def _millis(when):
+    return int(when.timestamp() * 1000)
+
+
+def _sent_at(entry_id):
+    return datetime.fromtimestamp(int(entry_id.split("-")[0]) / 1000, tz=timezone.utc)
+
+
+def _document(entry_id, fields):
+    """Message document of a stream entry, as the flusher writes it."""
+    document = json.loads(fields["message"])
+    document["envelope"] = base64.b64decode(document["envelope"])
+    document["sent_at"] = _sent_at(entry_id)
+    return document
+
+
+class MessageOutbox:
+    """Redis Stream backed queue in front of the messages collection."""
+
+    def __init__(self, redis_client, get_db):
+        self.redis = redis_client
+        self.get_db = get_db
+        self._enqueue = redis_client.register_script(_ENQUEUE)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Forked children start their own flusher under their own consumer name
+        self._thread = None
+        self._lock = threading.Lock()
+        self._group_ready = False
+        self._last_claim = 0.0
+        self.consumer = f"{socket.gethostname()}-{os.getpid()}"
+
+    @timed("redis")
+    def enqueue(self, message_data):
+        """Queue a message document without its sent_at field.
+
+        Returns the document id and the sent_at the flusher will store.
+        """
+        document = dict(message_data, envelope=base64.b64encode(message_data["envelope"]).decode())
+        conversation_id = message_data["conversation_id"]
+        entry_id = self._enqueue(
+            keys=[OUTBOX_STREAM, conversation_key(conversation_id)], args=[conversation_id, json.dumps(document)]
+        )
+        self.start()
+        return message_id(entry_id, conversation_id), _sent_at(entry_id)
+
+    @timed("redis")
+    def queued(self, conversation_id, since=None, until=None):
+        """Messages of a conversation not flushed yet, oldest first.
+
+        `since` and `until` bound their sent_at, so pages that end before the
+        oldest queued message do no further lookups. Returns a list of
+        (message_id, document) like Message.page().
+        """
+        index = conversation_key(conversation_id)
+        entry_ids = self.redis.zrangebyscore(
+            index,
+            _millis(since) if since else "-inf",
+            _millis(until) if until else "+inf",
+        )
+        if not entry_ids:
+            return []
+
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.xrange(OUTBOX_STREAM, min=entry_id, max=entry_id)
+        messages, gone = [], []
+        for entry_id, entries in zip(entry_ids, pipe.execute()):
+            if not entries:
+                # Flushed after the index was read
+                gone.append(entry_id)
+                continue
+            try:
+                document = _document(entry_id, entries[0][1])
+            except (ValueError, KeyError):
+                # Left for the flusher to dead-letter
+                continue
+            messages.append((message_id(entry_id, conversation_id), document))
+        if gone:
+            self.redis.zrem(index, *gone)
+        messages.sort(key=lambda item: (item[1]["sent_at"], item[0]))
+        return messages
+
+    def start(self):
+        """Start the flusher thread of this process, if it is not running yet."""
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="outbox-flusher", daemon=True)
+                self._thread.start()
+
+    def _ensure_group(self):
+        if self._group_ready:
+            return
+        try:
+            self.redis.xgroup_create(OUTBOX_STREAM, OUTBOX_GROUP, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+        self._group_ready = True
+
+    def _run(self):
+        backoff = 0.5
+        while True:
+            try:
+                self.flush(block_ms=1000)
+                backoff = 0.5
+            except Exception as e:
+                print(f"⚠️ Warning: Outbox flush failed, retrying in {backoff:.1f}s: {e}")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, OUTBOX_MAX_BACKOFF)
+
+    def _read(self, start_id, count, block_ms=None):
+        response = self.redis.xreadgroup(
+            OUTBOX_GROUP, self.consumer, {OUTBOX_STREAM: start_id}, count=count, block=block_ms
+        )
+        return response[0][1] if response else []
+
+    def _next_batch(self, block_ms):
+        # Our own unacknowledged entries first (a failed commit), then entries
+        # abandoned by other consumers, then new ones
+        entries = self._read("0", OUTBOX_BATCH_SIZE)
+        if not entries and time.monotonic() - self._last_claim > OUTBOX_CLAIM_IDLE_MS / 2000:
+            self._last_claim = time.monotonic()
+            claimed = self.redis.xautoclaim(
+                OUTBOX_STREAM, OUTBOX_GROUP, self.consumer, OUTBOX_CLAIM_IDLE_MS, count=OUTBOX_BATCH_SIZE
+            )
+            entries = [entry for entry in claimed[1] if entry and entry[1]]
+        if not entries:
+            entries = self._read(">", OUTBOX_BATCH_SIZE, block_ms)
+            if entries and len(entries) < OUTBOX_BATCH_SIZE and OUTBOX_FLUSH_WINDOW_MS:
+                # Group commit: give a burst a moment to join the batch
+                time.sleep(OUTBOX_FLUSH_WINDOW_MS / 1000)
+                entries += self._read(">", OUTBOX_BATCH_SIZE - len(entries))
+        return entries
+
+    def flush(self, block_ms=None):
+        """Write one batch of queued messages to Firestore.
+
+        Returns how many entries left the stream, written or dead-lettered.
+        """
+        self._ensure_group()
+        entries = self._next_batch(block_ms)
+        if not entries:
+            return 0
+
+        db = self.get_db()
+        try:
+            self._write(db, entries)
+        except _TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            print(f"⚠️ Warning: Outbox batch of {len(entries)} failed, writing them one at a time: {e}")
+            return self._flush_each(db, entries)
+        self._finish(entries)
+        return len(entries)
+
+    def _write(self, db, entries):
+        messages_ref = db.collection("messages")
+        batch = db.batch()
+        for entry_id, fields in entries:
+            document = _document(entry_id, fields)
+            batch.set(messages_ref.document(message_id(entry_id, document["conversation_id"])), document)
+        with timed("firestore.write"):
+            batch.commit()
+
+    def _flush_each(self, db, entries):
+        """Write entries one by one, dead-lettering those out of deliveries.
+
+        Raises the first error of an entry that is left pending for a retry.
+        """
+        written, dead, error = [], [], None
+        try:
+            for entry_id, fields in entries:
+                try:
+                    self._write(db, [(entry_id, fields)])
+                except _TRANSIENT_ERRORS:
+                    raise
+                except Exception as e:
+                    if self._deliveries(entry_id) >= OUTBOX_MAX_DELIVERIES:
+                        dead.append((entry_id, fields, e))
+                    else:
+                        error = error or e
+                    continue
+                written.append((entry_id, fields))
+        finally:
+            self._finish(written, dead)
+        if error is not None:
+            raise error
+        return len(written) + len(dead)
+
+    def _deliveries(self, entry_id):
+        pending = self.redis.xpending_range(OUTBOX_STREAM, OUTBOX_GROUP, min=entry_id, max=entry_id, count=1)
+        return pending[0]["times_delivered"] if pending else 0
+
+    def _finish(self, entries, dead=()):
+        """Acknowledge, delete and unindex written entries, moving `dead` ones to the dead-letter stream."""
+        if not entries and not dead:
+            return
+        pipe = self.redis.pipeline(transaction=False)
+        for entry_id, fields, error in dead:
+            print(f"⚠️ Warning: Moving outbox entry {entry_id} to {OUTBOX_DEAD_STREAM}: {error}")
+            pipe.xadd(OUTBOX_DEAD_STREAM, dict(fields, entry_id=entry_id, error=str(error)))
+        entries = list(entries) + [(entry_id, fields) for entry_id, fields, _ in dead]
+        for entry_id, fields in entries:
+            if "conversation_id" in fields:
+                pipe.zrem(conversation_key(fields["conversation_id"]), entry_id)
+        entry_ids = [entry_id for entry_id, _ in entries]
+        pipe.xack(OUTBOX_STREAM, OUTBOX_GROUP, *entry_ids)
+        pipe.xdel(OUTBOX_STREAM, *entry_ids)
+        pipe.execute()
+
+    def drain(self):
+        """Flush until the stream holds nothing for this consumer, returns the count flushed."""
+        written = 0
+        while True:
+            count = self.flush()
+            if not count:
+                return written
+            written += count
+
+
+def create_outbox(session_store, get_db):
+    """Outbox on the session store's Redis, or None to write messages synchronously."""
+    redis_client = getattr(session_store, "redis", None)
+    if not OUTBOX_ENABLED or redis_client is None:
+        return None
+    return MessageOutbox(redis_client, get_db)
+
+
+if __name__ == "__main__":
+    # Write out everything still queued, e.g. before taking Redis down
+    from firebase_init import get_db
+    from session_store import redis_from_env
+
+    print(f"Flushed {MessageOutbox(redis_from_env(), get_db).drain()} queued messages")
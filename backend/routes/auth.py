@@ -1,9 +1,17 @@
-from flask import Blueprint, request, jsonify, current_app, g
+from flask import Blueprint, Response, request, jsonify, current_app, g, stream_with_context
 import secrets
 import os
+import itertools
+import threading
+import json
+import base64
 from datetime import datetime, timezone
 import jwt
 from models.user import User
+from models.message import Message, InvalidPageToken
+from models.notification import Notification, InvalidNotificationToken
+from metrics import timed, timed_iter
+from envelope import pack_key_wrap, key_wrap_id
 from security import (
     validate_username,
     validate_password,
@@ -12,16 +20,40 @@ from security import (
     encrypt_secret_key,
     decrypt_secret_key,
     decrypt_message,
-    encrypt_message,
+    pending_key_wraps,
+    unwrap_aes_key,
+    seal_message,
     encrypt_aes_key,
-    generate_key_pair
-
+    forget_session_keys,
+)
+from keypool import keypair_pool
+from workers import (
+    kdf_pool,
+    decrypt_pool,
+    PoolSaturated,
+    DECRYPT_CHUNK_SIZE,
+    DECRYPT_PARALLEL_THRESHOLD,
 )
 from firebase_admin import firestore
+from firebase_init import get_db
 
 
 auth_bp = Blueprint("auth", __name__, url_prefix="/api")
 
+MESSAGES_PAGE_LIMIT = int(os.getenv("MESSAGES_PAGE_LIMIT", 100))
+MESSAGES_MAX_LIMIT = int(os.getenv("MESSAGES_MAX_LIMIT", 500))
+MESSAGES_STREAM_MAX_LIMIT = int(os.getenv("MESSAGES_STREAM_MAX_LIMIT", 5000))
+NOTIFICATIONS_PAGE_LIMIT = int(os.getenv("NOTIFICATIONS_PAGE_LIMIT", 50))
+NOTIFICATIONS_MAX_LIMIT = int(os.getenv("NOTIFICATIONS_MAX_LIMIT", 200))
+STREAM_HEARTBEAT_SECONDS = int(os.getenv("STREAM_HEARTBEAT_SECONDS", 15))
+# Under gthread an open stream holds a request thread for its whole life, so
+# only a share of the threads may serve streams; the gevent stream service
+# raises the cap (gunicorn.stream.conf.py). Clients over the cap poll
+STREAM_MAX_PER_WORKER = int(os.getenv("STREAM_MAX_PER_WORKER", max(1, int(os.getenv("GUNICORN_THREADS", 8)) // 4)))
+STREAM_POLL_INTERVAL = int(os.getenv("STREAM_POLL_INTERVAL", 5))
+
+_stream_slots = threading.BoundedSemaphore(STREAM_MAX_PER_WORKER)
+
 
 # --- Registration ---
 @auth_bp.route("/register", methods=["POST"])
@@ -46,16 +78,14 @@ def register():
         if password != confirm_password:
             return jsonify({"error": "Passwords do not match"}), 400
 
-        db = firestore.client()
-        if User.get_by_username(db, username):
+        db = get_db()
+        username_index = current_app.username_index
+        if User.username_taken(db, username, index=username_index):
             return jsonify({"error": "Username already exists"}), 409
 
-        public_key, private_key = generate_key_pair()
-
-        salt = os.urandom(16)
-        iv = os.urandom(16)
-        encrypted_sk = encrypt_secret_key(private_key, password, salt, iv)
-        password_hash = hash_password(password)
+        public_key, private_key, encrypted_sk, iv, salt, password_hash = kdf_pool.run(
+            _registration_keys, password
+        )
 
         new_user = User(
             username=username,
@@ -66,18 +96,18 @@ def register():
             salt=salt.hex(),
         )
 
-        user_id = new_user.save(db)
+        user_id = new_user.save(db, index=username_index)
 
         # Session ID
         session_id = secrets.token_hex(16)
-        redis_client = current_app.redis_client
 
-        # Store session in Redis (manually, with string values)
-        redis_client.hset(f"session:{session_id}", "user_id", str(user_id))
-        redis_client.hset(f"session:{session_id}", "username", username)
-        redis_client.hset(f"session:{session_id}", "private_key", private_key)
-        redis_client.hset(f"session:{session_id}", "created_at", datetime.now(timezone.utc).isoformat())
-        redis_client.expire(f"session:{session_id}", 3600)
+        # Store session in Redis (with string values)
+        current_app.session_store.create(session_id, {
+            "user_id": str(user_id),
+            "username": username,
+            "private_key": private_key,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+        })
 
         token = jwt.encode(
             {"user_id": user_id, "session_id": session_id},
@@ -92,9 +122,31 @@ def register():
             "token": token,
         }), 201
 
+    except PoolSaturated as e:
+        return _busy_response(e)
     except Exception as e:
         return jsonify({"error": f"Registration failed: {str(e)}"}), 500
 
+
+def _registration_keys(password):
+    """Secret key encryption and password hashing, run on the KDF pool.
+
+    The keypair normally comes pre-generated from the keypair pool.
+    """
+    public_key, private_key = keypair_pool.take()
+
+    salt = os.urandom(16)
+    iv = os.urandom(16)
+    encrypted_sk = encrypt_secret_key(private_key, password, salt, iv)
+    password_hash = hash_password(password)
+    return public_key, private_key, encrypted_sk, iv, salt, password_hash
+
+
+def _busy_response(error):
+    response = jsonify({"error": "Server is busy, please retry shortly"})
+    response.headers["Retry-After"] = str(error.retry_after)
+    return response, 503
+
 # --- Login ---
 @auth_bp.route("/login", methods=["POST"])
 def login():
@@ -106,46 +158,38 @@ def login():
         if not username or not password:
             return jsonify({"error": "Username and password are required"}), 400
 
-        db = firestore.client()
-        user_doc = User.get_by_username(db, username)
-        if not user_doc or not check_password(password, user_doc.password_hash):
+        db = get_db()
+        user_doc = User.get_by_username(db, username, index=current_app.username_index)
+        if not user_doc:
             return jsonify({"error": "Invalid username or password"}), 401
 
         user_data = user_doc.to_dict()
-        sender_pk = bytes.fromhex(user_data.get("public_key", ""))
         if not user_data:
             return jsonify({"error": "User data not found"}), 404
 
-        user_private_key = user_data.get("encrypted_secret_key", "")
-        if not user_private_key:
+        if not user_data.get("encrypted_secret_key", ""):
             return jsonify({"error": "User private key not found"}), 404
 
-        user_salt_hex = user_data.get("salt", "")
-        user_iv_hex = user_data.get("iv", "")
-        decrypted_private_key = decrypt_secret_key(
-            user_private_key, password, user_salt_hex, user_iv_hex
-        )
+        unlocked = kdf_pool.run(_login_keys, password, user_data)
+        if unlocked is None:
+            return jsonify({"error": "Invalid username or password"}), 401
+
+        decrypted_private_key, aes_key, ct_sender, encrypted_aes_key_sender, iv_sender = unlocked
         if not decrypted_private_key:
             return jsonify({"error": "Decryption failed"}), 500
-        
-        #create a aes key for the session
-        aes_key = secrets.token_bytes(32) # 256-bit aes key
-        
-        #wrap the AES key for sender 
-        ct_sender, encrypted_aes_key_sender, iv_sender = encrypt_aes_key(sender_pk, aes_key)
 
         # Store session in Redis
         session_id = secrets.token_hex(16)
-        redis_client = current_app.redis_client
-
-
-        redis_client.hset(f"session:{session_id}", "private_key", decrypted_private_key)  # No .hex()
-        redis_client.hset(f"session:{session_id}", "aes_key", aes_key.hex())
-        redis_client.hset(f"session:{session_id}", "ct_sender", ct_sender.hex())
-        redis_client.hset(f"session:{session_id}", "encrypted_aes_key", encrypted_aes_key_sender.hex())
-        redis_client.hset(f"session:{session_id}", "iv_sender", iv_sender.hex())
 
-        redis_client.expire(f"session:{session_id}", 3600)
+        current_app.session_store.create(session_id, {
+            "user_id": user_doc.id,
+            "username": user_doc.username,
+            "private_key": decrypted_private_key,  # No .hex()
+            "aes_key": aes_key.hex(),
+            "ct_sender": ct_sender.hex(),
+            "encrypted_aes_key": encrypted_aes_key_sender.hex(),
+            "iv_sender": iv_sender.hex(),
+        })
 
         token = jwt.encode(
             {"user_id": user_doc.id, "session_id": session_id},
@@ -155,9 +199,46 @@ def login():
 
         return jsonify({"message": "Login successful", "token": token}), 200
 
+    except PoolSaturated as e:
+        return _busy_response(e)
     except Exception as e:
         return jsonify({"error": f"Login failed: {str(e)}"}), 500
 
+
+def _login_keys(password, user_data):
+    """Password check, secret key decryption and session key wrap, run on the KDF pool.
+
+    Returns None when the password does not match.
+    """
+    if not check_password(password, user_data["password_hash"]):
+        return None
+
+    sender_pk = bytes.fromhex(user_data.get("public_key", ""))
+    decrypted_private_key = decrypt_secret_key(
+        user_data["encrypted_secret_key"], password, user_data.get("salt", ""), user_data.get("iv", "")
+    )
+
+    #create a aes key for the session
+    aes_key = secrets.token_bytes(32) # 256-bit aes key
+
+    #wrap the AES key for sender 
+    ct_sender, encrypted_aes_key_sender, iv_sender = encrypt_aes_key(sender_pk, aes_key)
+    return decrypted_private_key, aes_key, ct_sender, encrypted_aes_key_sender, iv_sender
+
+# --- Logout ---
+@auth_bp.route("/logout", methods=["POST"])
+def logout():
+    try:
+        session_id = g.session_id
+        # Deleting the hash also evicts it from every worker's session cache
+        current_app.session_store.delete(session_id)
+        current_app.session_cache.invalidate(session_id)
+        forget_session_keys(session_id)
+        return jsonify({"message": "Logged out"}), 200
+
+    except Exception as e:
+        return jsonify({"error": f"Logout failed: {str(e)}"}), 500
+
 # --- Middleware ---
 @auth_bp.before_request
 def require_auth():
@@ -186,7 +267,17 @@ def require_auth():
         # Set user and session info in g
         g.user_id = decoded_token["user_id"]
         g.session_id = decoded_token["session_id"]
-        
+
+        # Load the whole session once, so routes never go back to the store
+        # for it and a dead session is turned away before any other work
+        session, session_ttl = current_app.session_cache.load(g.session_id)
+        if session is None:
+            return jsonify({"error": "Session expired, please log in again"}), 401
+        if session.get("user_id", g.user_id) != g.user_id:
+            return jsonify({"error": "Invalid token"}), 401
+        g.session = session
+        g.session_ttl = session_ttl
+
     except jwt.ExpiredSignatureError:
         return jsonify({"error": "Token has expired"}), 401
     except jwt.InvalidTokenError:
@@ -200,17 +291,17 @@ def require_auth():
 def profile():
     try:
         user_id = g.user_id
-        db = firestore.client()
-        user_doc = User.get_by_id(db, user_id)
-        if not user_doc:
+        db = get_db()
+        user_profile = User.get_profile(db, current_app.session_store, user_id)
+        if not user_profile:
             return jsonify({"error": "User not found"}), 404
 
         return (
             jsonify(
                 {
-                    "user_id": user_doc.id,
-                    "username": user_doc.username,
-                    "created_at": user_doc.created_at.isoformat(),
+                    "user_id": user_id,
+                    "username": user_profile["username"],
+                    "created_at": user_profile["created_at"],
                 }
             ),
             200,
@@ -220,6 +311,26 @@ def profile():
         return jsonify({"error": f"Profile retrieval failed: {str(e)}"}), 500
 
 
+@firestore.transactional
+def _send_friend_request(transaction, db, user_id, friend_id):
+    """Add user_id to the friend's pending requests, returns an error response or None."""
+    users = User.get_fields(db, [user_id, friend_id], ["friends", "pending_request_from"], transaction=transaction)
+    if user_id not in users:
+        return jsonify({"error": "User not found"}), 404
+    if friend_id not in users:
+        return jsonify({"error": "Friend user data missing"}), 404
+
+    if friend_id in users[user_id].get("friends", []):
+        return jsonify({"error": "User is already your friend"}), 400
+    if user_id in users[friend_id].get("pending_request_from", []):
+        return jsonify({"error": "Friend request already sent"}), 400
+
+    transaction.update(db.collection("users").document(friend_id), {
+        "pending_request_from": firestore.ArrayUnion([user_id]),
+    })
+    return None
+
+
 @auth_bp.route("/add_friend", methods=["POST"])
 def add_friend():
     try:
@@ -229,37 +340,21 @@ def add_friend():
         if not friend_username:
             return jsonify({"error": "Friend username is required"}), 400
 
-        db = firestore.client()
-
-        user_doc = User.get_by_id(db, g.user_id)
-        if not user_doc:
-            return jsonify({"error": "User not found"}), 404
-
-        user_data = db.collection("users").document(g.user_id).get().to_dict()
+        db = get_db()
+        session_store = current_app.session_store
 
-        friend_doc = User.get_by_username(db, friend_username)
+        friend_doc = User.get_by_username(db, friend_username, index=current_app.username_index)
         if not friend_doc:
             return jsonify({"error": "Friend not found"}), 404
 
-        if friend_doc.id == user_doc.id:
+        if friend_doc.id == g.user_id:
             return jsonify({"error": "You cannot add yourself as a friend"}), 400
-        if friend_doc.id in user_data.get("friends", []):
-            return jsonify({"error": "User is already your friend"}), 400
-
-        friend_ref = db.collection("users").document(friend_doc.id)
-        friend_data = friend_ref.get().to_dict()
-
-        if not friend_data:
-            return jsonify({"error": "Friend user data missing"}), 404
-
-        pending = friend_data.get("pending_request_from", [])
-
-        if g.user_id in pending:
-            return jsonify({"error": "Friend request already sent"}), 400
 
-        pending.append(g.user_id)
-
-        friend_ref.update({"pending_request_from": pending})
+        with timed("firestore.write"):
+            error = _send_friend_request(db.transaction(), db, g.user_id, friend_doc.id)
+        if error:
+            return error
+        User.invalidate(session_store, friend_doc.id)
 
         return jsonify({"message": "Friend request sent successfully"}), 200
 
@@ -270,22 +365,20 @@ def add_friend():
 @auth_bp.route("/get_requests", methods=["GET"])
 def get_friend_requests():
     try:
-        db = firestore.client()
-        user_ref = db.collection("users").document(g.user_id)
-        user_doc = user_ref.get()
+        db = get_db()
+        user_profile = User.get_profile(db, current_app.session_store, g.user_id)
 
-        if not user_doc.exists:
+        if not user_profile:
             return jsonify({"error": "User not found"}), 404
 
-        data = user_doc.to_dict()
-        pending_ids = data.get("pending_request_from", [])
+        pending_ids = user_profile["pending_request_from"]
 
-        users = []
-        for uid in pending_ids:
-            u_doc = db.collection("users").document(uid).get()
-            if u_doc.exists:
-                u_data = u_doc.to_dict()
-                users.append({"id": uid, "username": u_data.get("username", "Unknown")})
+        usernames = User.get_usernames(db, pending_ids)
+        users = [
+            {"id": uid, "username": usernames[uid]}
+            for uid in pending_ids
+            if uid in usernames
+        ]
 
         return jsonify(users), 200
 
@@ -293,6 +386,42 @@ def get_friend_requests():
         return jsonify({"error": f"Failed to fetch requests: {str(e)}"}), 500
 
 
+@firestore.transactional
+def _answer_friend_request(transaction, db, user_id, from_user_id, kind):
+    """Resolve a pending friend request, returns an error response or None.
+
+    Both user documents are read inside the transaction, so a request that
+    was already answered (or never sent) is rejected instead of written.
+    """
+    users = User.get_fields(db, [user_id, from_user_id], ["username", "pending_request_from"], transaction=transaction)
+    if user_id not in users or from_user_id not in users:
+        return jsonify({"error": "User not found"}), 404
+
+    current_data = users[user_id]
+    if from_user_id not in current_data.get("pending_request_from", []):
+        return jsonify({"error": "No pending friend request from this user"}), 400
+
+    users_ref = db.collection("users")
+    current_ref = users_ref.document(user_id)
+    sender_ref = users_ref.document(from_user_id)
+    # Field transforms: concurrent requests cannot overwrite each other's list edits
+    if kind == "accept":
+        transaction.update(current_ref, {
+            "pending_request_from": firestore.ArrayRemove([from_user_id]),
+            "friends": firestore.ArrayUnion([from_user_id]),
+        })
+        transaction.update(sender_ref, {
+            "friends": firestore.ArrayUnion([user_id]),
+        })
+    else:
+        transaction.update(current_ref, {
+            "pending_request_from": firestore.ArrayRemove([from_user_id]),
+        })
+    # Send notification to sender
+    Notification.add(transaction, db, from_user_id, current_data.get("username") or "Unknown", kind)
+    return None
+
+
 @auth_bp.route("/accept_request", methods=["POST"])
 def accept_friend_request():
     try:
@@ -302,48 +431,13 @@ def accept_friend_request():
         if not from_user_id:
             return jsonify({"error": "Sender user ID is required"}), 400
 
-        db = firestore.client()
-
-        current_ref = db.collection("users").document(g.user_id)
-        sender_ref = db.collection("users").document(from_user_id)
-
-        current_doc = current_ref.get()
-        sender_doc = sender_ref.get()
-
-        if not current_doc.exists or not sender_doc.exists:
-            return jsonify({"error": "User not found"}), 404
-
-        current_data = current_doc.to_dict()
-        sender_data = sender_doc.to_dict()
-
-        pending = current_data.get("pending_request_from", [])
-        if from_user_id in pending:
-            pending.remove(from_user_id)
-
-        current_friends = current_data.get("friends", [])
-        sender_friends = sender_data.get("friends", [])
-
-        if from_user_id not in current_friends:
-            current_friends.append(from_user_id)
-        if g.user_id not in sender_friends:
-            sender_friends.append(g.user_id)
-
-        # Update both user docs
-        current_ref.update(
-            {"pending_request_from": pending, "friends": current_friends}
-        )
-        sender_ref.update({"friends": sender_friends})
-
-        # Send notification to sender
-        sender_notifications = sender_data.get("notifications", [])
-        sender_notifications.append(
-            {
-                "username": current_data.get("username", "Unknown"),
-                "type": "accept",
-                "time": datetime.utcnow().isoformat(),
-            }
-        )
-        sender_ref.update({"notifications": sender_notifications})
+        db = get_db()
+        with timed("firestore.write"):
+            error = _answer_friend_request(db.transaction(), db, g.user_id, from_user_id, "accept")
+        if error:
+            return error
+        User.invalidate(current_app.session_store, g.user_id, from_user_id)
+        _trim_notifications(db, from_user_id)
 
         return jsonify({"message": "Friend request accepted"}), 200
 
@@ -360,36 +454,13 @@ def decline_friend_request():
         if not from_user_id:
             return jsonify({"error": "Sender user ID is required"}), 400
 
-        db = firestore.client()
-
-        current_ref = db.collection("users").document(g.user_id)
-        sender_ref = db.collection("users").document(from_user_id)
-
-        current_doc = current_ref.get()
-        sender_doc = sender_ref.get()
-
-        if not current_doc.exists or not sender_doc.exists:
-            return jsonify({"error": "User not found"}), 404
-
-        current_data = current_doc.to_dict()
-        sender_data = sender_doc.to_dict()
-
-        pending = current_data.get("pending_request_from", [])
-        if from_user_id in pending:
-            pending.remove(from_user_id)
-
-        current_ref.update({"pending_request_from": pending})
-
-        # Send notification to sender
-        sender_notifications = sender_data.get("notifications", [])
-        sender_notifications.append(
-            {
-                "username": current_data.get("username", "Unknown"),
-                "type": "decline",
-                "time": datetime.utcnow().isoformat(),
-            }
-        )
-        sender_ref.update({"notifications": sender_notifications})
+        db = get_db()
+        with timed("firestore.write"):
+            error = _answer_friend_request(db.transaction(), db, g.user_id, from_user_id, "decline")
+        if error:
+            return error
+        User.invalidate(current_app.session_store, g.user_id)
+        _trim_notifications(db, from_user_id)
 
         return jsonify({"message": "Friend request declined"}), 200
 
@@ -397,31 +468,36 @@ def decline_friend_request():
         return jsonify({"error": f"Failed to decline request: {str(e)}"}), 500
 
 
+def _trim_notifications(db, user_id):
+    # Keeps the list capped where it grows, reading it stays read-only.
+    # Best effort, the new notification is already stored.
+    try:
+        Notification.trim(db, user_id)
+    except Exception as e:
+        print(f"⚠️ Warning: Could not trim notifications of user {user_id}: {e}")
+
+
 @auth_bp.route("/get_friends", methods=["GET"])
 def get_friends():
     try:
-        db = firestore.client()
-        user_ref = db.collection("users").document(g.user_id)
-        user_doc = user_ref.get()
+        db = get_db()
+        user_profile = User.get_profile(db, current_app.session_store, g.user_id)
 
-        if not user_doc.exists:
+        if not user_profile:
             return jsonify({"error": "User not found"}), 404
 
-        data = user_doc.to_dict()
-        friend_ids = data.get("friends", [])
-
-        friends = []
-        for fid in friend_ids:
-            friend_doc = db.collection("users").document(fid).get()
-            if friend_doc.exists:
-                f_data = friend_doc.to_dict()
-                friends.append(
-                    {
-                        "id": fid,
-                        "username": f_data.get("username", "Unknown"),
-                        # You can add more fields if needed like profile pics etc.
-                    }
-                )
+        friend_ids = user_profile["friends"]
+
+        usernames = User.get_usernames(db, friend_ids)
+        friends = [
+            {
+                "id": fid,
+                "username": usernames[fid],
+                # You can add more fields if needed like profile pics etc.
+            }
+            for fid in friend_ids
+            if fid in usernames
+        ]
 
         return jsonify(friends), 200
 
@@ -430,17 +506,24 @@ def get_friends():
 
 
 @auth_bp.route("/get_friend_accept_notifications", methods=["GET"])
+@auth_bp.route("/notifications", methods=["GET"])
 def get_friend_accept_notifications():
     try:
-        db = firestore.client()
-        current_user_ref = db.collection("users").document(g.user_id)
-        current_user_doc = current_user_ref.get()
-
-        if not current_user_doc.exists:
-            return jsonify({"error": "User not found"}), 404
-
-        user_data = current_user_doc.to_dict()
-        notifications = user_data.get("notifications", [])
+        try:
+            limit = int(request.args.get("limit", NOTIFICATIONS_PAGE_LIMIT))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+        limit = min(limit, NOTIFICATIONS_MAX_LIMIT)
+        # Id of the last notification of the previous page
+        before = request.args.get("before")
+
+        db = get_db()
+        try:
+            notifications = Notification.page(db, g.user_id, limit, before=before)
+        except InvalidNotificationToken as e:
+            return jsonify({"error": str(e)}), 400
 
         return jsonify(notifications), 200
 
@@ -448,23 +531,39 @@ def get_friend_accept_notifications():
         return jsonify({"error": f"Failed to fetch notifications: {str(e)}"}), 500
 
 
+@auth_bp.route("/notifications/read", methods=["POST"])
+def mark_notifications_read():
+    try:
+        data = request.get_json() or {}
+        notification_ids = data.get("ids")
+
+        if not isinstance(notification_ids, list) or not all(isinstance(i, str) and i for i in notification_ids):
+            return jsonify({"error": "ids must be a list of notification ids"}), 400
+        if len(notification_ids) > NOTIFICATIONS_MAX_LIMIT:
+            return jsonify({"error": f"At most {NOTIFICATIONS_MAX_LIMIT} ids per request"}), 400
+
+        updated = Notification.mark_read(get_db(), g.user_id, notification_ids)
+        return jsonify({"message": "Notifications marked as read", "updated": updated}), 200
+
+    except Exception as e:
+        return jsonify({"error": f"Failed to update notifications: {str(e)}"}), 500
+
+
 @auth_bp.route("/friend/<friend_id>", methods=["GET"])
 def get_friend_by_id(friend_id):
     try:
-        db = firestore.client()
-        friend_doc = db.collection("users").document(friend_id).get()
+        db = get_db()
+        friend_profile = User.get_profile(db, current_app.session_store, friend_id)
 
-        if not friend_doc.exists:
+        if not friend_profile:
             return jsonify({"error": "Friend not found"}), 404
 
-        friend_data = friend_doc.to_dict()
-
         # Return only relevant fields, exclude sensitive info
         result = {
             "id": friend_id,
-            "username": friend_data.get("username", "Unknown"),
-            "profilePic": friend_data.get("profilePic", None),  # if stored
-            "joinedDate": friend_data.get("created_at", None),
+            "username": friend_profile["username"] or "Unknown",
+            "profilePic": friend_profile["profilePic"],  # if stored
+            "joinedDate": friend_profile["created_at"],
         }
 
         return jsonify(result), 200
@@ -475,64 +574,94 @@ def get_friend_by_id(friend_id):
 @auth_bp.route("/friend/<friend_id>/<message>", methods=["POST"])
 def chat_message(friend_id, message):
     try:
-        db = firestore.client()
-        redis_client = current_app.redis_client
+        db = get_db()
+        session_store = current_app.session_store
         session = g.session_id
         # Get both of'em's data
-        user_doc = db.collection("users").document(g.user_id).get()
-        friend_doc = db.collection("users").document(friend_id).get()
-        print("user docs found")
+        user_profile = User.get_profile(db, session_store, g.user_id)
+        friend_profile = User.get_profile(db, session_store, friend_id)
 
-        if not user_doc.exists or not friend_doc.exists:
+        if not user_profile or not friend_profile:
             return jsonify({"error": "User or friend not found"}), 404
         # get actual public keys
-        receiver_pk = bytes.fromhex(friend_doc.to_dict().get("public_key"))
-
-        # Retrieve session aes key from redis server
-        aes_key = bytes.fromhex(redis_client.hget(f"session:{session}", "aes_key"))
-        iv_message = secrets.token_bytes(16)
-        encrypted_message = encrypt_message(aes_key,message,iv_message)
-
-        # Retrieve the wrapped aes key for receiver if exists
-        encrypted_aes_key_receiver = redis_client.hget(f"session:{friend_id}", "encrypted_aes_key")
-        if encrypted_aes_key_receiver: 
-            encrypted_aes_key_receiver = bytes.fromhex(encrypted_aes_key_receiver)
-            iv_receiver = bytes.fromhex(redis_client.hget(f"session:{friend_id}", "iv_receiver"))
-            ct_receiver = bytes.fromhex(redis_client.hget(f"session:{friend_id}", "ct_receiver"))
-        else:
+        receiver_pk = bytes.fromhex(friend_profile["public_key"])
+
+        # The session aes key, its sender wrap and the key envelope already
+        # used with this friend, loaded by require_auth
+        envelope_field = f"envelope:{friend_id}"
+        session_data = g.session
+        if not session_data.get("aes_key"):
+            return jsonify({"error": "Session not found"}), 404
+
+        aes_key = bytes.fromhex(session_data["aes_key"])
+        payload = seal_message(aes_key, message, g.user_id, friend_id, cache_scope=session, cache_ttl=g.session_ttl)
+
+        batch = db.batch()
+
+        # Both wraps of the session aes key are stored once per session and friend
+        envelope_id = session_data.get(envelope_field)
+        new_envelope = not envelope_id
+        if new_envelope:
             #  Wrap the AES key for receiver
             ct_receiver, encrypted_aes_key_receiver, iv_receiver = encrypt_aes_key(receiver_pk, aes_key) 
 
-            # Store wrapped key in redis for future use
-            redis_client.hset(f"session:{friend_id}", "encrypted_aes_key", encrypted_aes_key_receiver.hex())
-            redis_client.hset(f"session:{friend_id}", "iv_receiver", iv_receiver.hex())
-            redis_client.hset(f"session:{friend_id}", "ct_receiver", ct_receiver.hex())
-
-        # Retrieve the wrapped aes key for sender
-        
-        encrypted_aes_key_sender = bytes.fromhex(redis_client.hget(f"session:{session}", "encrypted_aes_key"))
-        iv_sender = bytes.fromhex(redis_client.hget(f"session:{session}", "iv_sender"))
-        ct_sender = bytes.fromhex(redis_client.hget(f"session:{session}", "ct_sender"))
-        #  Store in database
-     
-        db.collection("messages").add({
+            # The wrapped aes key for sender
+            encrypted_aes_key_sender = bytes.fromhex(session_data["encrypted_aes_key"])
+            iv_sender = bytes.fromhex(session_data["iv_sender"])
+            ct_sender = bytes.fromhex(session_data["ct_sender"])
+
+            wrap = pack_key_wrap({
+                "receiver_ciphertext": ct_receiver,
+                "receiver_encrypted_key": encrypted_aes_key_receiver,
+                "receiver_iv": iv_receiver,
+
+                "sender_ciphertext": ct_sender,
+                "sender_encrypted_key": encrypted_aes_key_sender,
+                "sender_iv": iv_sender,
+            })
+            envelope_id = key_wrap_id(wrap)
+            batch.set(db.collection("key_envelopes").document(envelope_id), {
+                "from": g.user_id,
+                "to": friend_id,
+                "wrap": wrap,
+                "created_at": datetime.now(timezone.utc).isoformat(),
+            })
+
+        message_data = {
             "from": g.user_id,
             "to": friend_id,
-            "message": encrypted_message.hex(),
-            "iv_message": iv_message.hex(),
-
-            "receiver_ciphertext": ct_receiver.hex(),
-            "receiver_encrypted_key": encrypted_aes_key_receiver.hex(),
-            "receiver_iv": iv_receiver.hex(),
+            "envelope_id": envelope_id,
+            "envelope": payload,
+            "conversation_id": Message.conversation_id(g.user_id, friend_id),
+            "timestamp": datetime.now(timezone.utc).isoformat()
+        }
 
-            "sender_ciphertext": ct_sender.hex(),
-            "sender_encrypted_key": encrypted_aes_key_sender.hex(),
-            "sender_iv": iv_sender.hex(),
+        outbox = current_app.outbox
+        if outbox is not None:
+            # A new key envelope is committed first, so it exists before any
+            # queued message that refers to it is flushed or streamed
+            if new_envelope:
+                with timed("firestore.write"):
+                    batch.commit()
+            message_id, sent_at = outbox.enqueue(message_data)
+            # Streamed messages carry the sent_at that get_messages pages by
+            message_data["sent_at"] = sent_at.isoformat()
+        else:
+            #  Store in database, together with the key envelope if it is new
+            message_ref = db.collection("messages").document()
+            # Server-assigned, orders the conversation; timestamp is for display
+            batch.set(message_ref, dict(message_data, sent_at=firestore.SERVER_TIMESTAMP))
+            with timed("firestore.write"):
+                batch.commit()
+            message_id = message_ref.id
 
-            "timestamp": datetime.now(timezone.utc).isoformat()
-        })
+        if new_envelope:
+            session_store.update(session, {envelope_field: envelope_id})
+            # Other workers hear about the write through keyspace notifications
+            current_app.session_cache.invalidate(session)
 
-        redis_client.expire(f"session:{session}", 3600)
+        # Push the message to anyone streaming this conversation
+        _publish_message(session_store, message_id, message_data)
 
 
         return jsonify({"message": "Secure message sent!"}), 200
@@ -543,85 +672,285 @@ def chat_message(friend_id, message):
 
 
 
+def _conversation_channel(user_a, user_b):
+    """Pub/sub channel shared by both participants of a conversation."""
+    return "chat:" + ":".join(sorted([user_a, user_b]))
+
+
+def _publish_message(session_store, message_id, message_data):
+    # Delivery is best effort, polling clients still pick the message up
+    try:
+        payload = dict(message_data, id=message_id)
+        payload["envelope"] = base64.b64encode(message_data["envelope"]).decode()
+        session_store.publish(
+            _conversation_channel(message_data["from"], message_data["to"]),
+            json.dumps(payload),
+        )
+    except Exception as e:
+        print(f"⚠️ Warning: Could not publish message {message_id}: {e}")
+
+
+@auth_bp.route("/stream/<friend_id>", methods=["GET"])
+def stream_messages(friend_id):
+    """Server-Sent Events stream of new messages in a conversation.
+
+    Answers 503 with Retry-After once this worker serves STREAM_MAX_PER_WORKER
+    streams; the client then polls get_messages and tries again later.
+    """
+    if not _stream_slots.acquire(blocking=False):
+        response = jsonify({"error": "Too many open message streams, poll instead"})
+        response.headers["Retry-After"] = str(STREAM_POLL_INTERVAL)
+        return response, 503
+
+    subscription = None
+    released = threading.Lock()
+
+    def release():
+        # Runs when the stream ends and when the response is closed, acts once
+        if not released.acquire(blocking=False):
+            return
+        if subscription is not None:
+            subscription.close()
+        _stream_slots.release()
+
+    try:
+        session_store = current_app.session_store
+        session_id = g.session_id
+        current_user_id = g.user_id
+
+        private_key_hex = g.session.get("private_key")
+        if not private_key_hex:
+            release()
+            return jsonify({"error": "Session not found"}), 404
+        private_key = bytes.fromhex(private_key_hex)
+
+        db = get_db()
+        subscription = session_store.subscribe(_conversation_channel(current_user_id, friend_id))
+    except Exception as e:
+        release()
+        return jsonify({"error": f"Failed to open message stream: {str(e)}"}), 500
+
+    def events():
+        # Key envelopes seen on this stream, a session reuses one per direction
+        key_envelopes = {}
+        try:
+            yield ": connected\n\n"
+            while True:
+                data = subscription.get_message(timeout=STREAM_HEARTBEAT_SECONDS)
+                if data is None:
+                    # Idle: stop once the session is gone, otherwise keep the connection warm
+                    if session_store.ttl(session_id) is None:
+                        yield "event: end\ndata: {}\n\n"
+                        return
+                    yield ": ping\n\n"
+                    continue
+
+                msg = json.loads(data)
+                msg["envelope"] = base64.b64decode(msg["envelope"])
+                session_ttl = session_store.ttl(session_id)
+                try:
+                    envelope_id = msg.get("envelope_id")
+                    if envelope_id and envelope_id not in key_envelopes:
+                        key_envelopes.update(_load_key_envelopes(db, [envelope_id]))
+                    msg = _decrypted_message(
+                        msg["id"],
+                        msg,
+                        current_user_id,
+                        private_key,
+                        cache_scope=session_id,
+                        cache_ttl=session_ttl,
+                        key_envelopes=key_envelopes,
+                    )
+                except Exception as e:
+                    print(f"⚠️ Warning: Could not decrypt streamed message {msg.get('id')}: {e}")
+                    continue
+                yield f"id: {msg['id']}\nevent: message\ndata: {json.dumps(msg)}\n\n"
+        finally:
+            release()
+
+    response = Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    # Also covers a client that disconnects before the body starts
+    response.call_on_close(release)
+    return response
+
+
 @auth_bp.route("/get_messages/<friend_id>", methods=["GET"])
 def get_messages(friend_id):
+    """Decrypted page of a conversation, as one JSON array or, with
+    ?format=ndjson or Accept: application/x-ndjson, one message per line
+    written as soon as it is decrypted."""
     try:
-        db = firestore.client()
+        # Optional page tokens (message ids): messages after or before that one
+        after = request.args.get("after", "").strip() or None
+        before = request.args.get("before", "").strip() or None
+        if after and before:
+            return jsonify({"error": "Use either after or before, not both"}), 400
+        # The token's sent_at, so a message that is still queued works as a token
+        sent_at = request.args.get("sent_at", "").strip() or None
+        if sent_at:
+            if not (after or before):
+                return jsonify({"error": "sent_at needs an after or before token"}), 400
+            try:
+                sent_at = datetime.fromisoformat(sent_at)
+            except ValueError:
+                return jsonify({"error": "sent_at must be an ISO 8601 timestamp"}), 400
+            if sent_at.tzinfo is None:
+                sent_at = sent_at.replace(tzinfo=timezone.utc)
+        try:
+            limit = int(request.args.get("limit", MESSAGES_PAGE_LIMIT))
+        except ValueError:
+            return jsonify({"error": "limit must be an integer"}), 400
+        if limit < 1:
+            return jsonify({"error": "limit must be positive"}), 400
+        ndjson = _wants_ndjson()
+        limit = min(limit, MESSAGES_STREAM_MAX_LIMIT if ndjson else MESSAGES_MAX_LIMIT)
+
+        db = get_db()
         current_user_id = g.user_id
+        session_store = current_app.session_store
         # Get both of'em's data
-        user_doc = db.collection("users").document(current_user_id).get()
-        friend_doc = db.collection("users").document(friend_id).get()
+        user_profile = User.get_profile(db, session_store, current_user_id)
+        friend_profile = User.get_profile(db, session_store, friend_id)
 
-        if not user_doc.exists or not friend_doc.exists:
+        if not user_profile or not friend_profile:
             return jsonify({"error": "User or friend not found"}), 404 
 
         # get user's private key 
-        redis_client = current_app.redis_client
         session_id = g.session_id
-        private_key_hex = redis_client.hget(f"session:{session_id}", "private_key")
+        # Unwrapped AES keys are cached for as long as the session lives
+        session_ttl = g.session_ttl
+        private_key_hex = g.session.get("private_key")
         if not private_key_hex: 
             return jsonify({"error": "Session not found"}), 404
 
         private_key = bytes.fromhex(private_key_hex)
 
-        messages_ref = db.collection("messages")
-        sent_query = messages_ref.where("from", "==", current_user_id).where(
-            "to", "==", friend_id
-        )
-        recv_query = messages_ref.where("from", "==", friend_id).where(
-            "to", "==", current_user_id
-        )
-
-        sent_msgs = sent_query.stream()
-        recv_msgs = recv_query.stream()
-        all_msgs = []
-
-        for msg in sent_msgs:
-            data = msg.to_dict()
-            all_msgs.append(
-            {
-                "from": data["from"],
-                "to": data["to"],
-                "message": data["message"],
-                "iv_message": data["iv_message"],
-                "sender_ciphertext": data["sender_ciphertext"],
-                "sender_encrypted_key": data["sender_encrypted_key"],
-                "sender_iv": data["sender_iv"],
-                "receiver_ciphertext": data["receiver_ciphertext"],
-                "receiver_encrypted_key": data["receiver_encrypted_key"],
-                "receiver_iv": data["receiver_iv"],
-                "timestamp": data["timestamp"],
-            }
+        conversation_id = Message.conversation_id(current_user_id, friend_id)
+        # Read the outbox before Firestore, so a message flushed in between is in one of them
+        outbox = current_app.outbox
+        queued = []
+        if outbox is not None:
+            # Only the queued messages that can fall inside the requested window
+            queued = outbox.queued(
+                conversation_id, since=sent_at if after else None, until=sent_at if before else None
+            )
+        try:
+            docs = Message.iter_page(
+                db, conversation_id, limit, before=before, after=after, sent_at=sent_at, queued=queued
+            )
+        except InvalidPageToken as e:
+            return jsonify({"error": str(e)}), 400
+
+        if ndjson:
+            # Fail with a status code while that is still possible: start the
+            # page and load the key envelopes known so far before the headers
+            docs = iter(docs)
+            first = next(docs, None)
+            known = ([first] if first else []) + queued
+            key_envelopes = _load_key_envelopes(db, {data.get("envelope_id") for _, data in known})
+            if first is not None:
+                docs = itertools.chain([first], docs)
+            return Response(
+                stream_with_context(
+                    _ndjson_messages(db, docs, current_user_id, private_key, session_id, session_ttl, key_envelopes)
+                ),
+                mimetype="application/x-ndjson",
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
             )
 
-        for msg in recv_msgs:
-            data = msg.to_dict()
-            all_msgs.append(
-            {
-                "from": data["from"],
-                "to": data["to"],
-                "message": data["message"],
-                "iv_message": data["iv_message"],
-                "sender_ciphertext": data["sender_ciphertext"],
-                "sender_encrypted_key": data["sender_encrypted_key"],
-                "sender_iv": data["sender_iv"],
-                "receiver_ciphertext": data["receiver_ciphertext"],
-                "receiver_encrypted_key": data["receiver_encrypted_key"],
-                "receiver_iv": data["receiver_iv"],
-                "timestamp": data["timestamp"],
-            }
+        docs = list(docs)
+        # Resolve every key envelope referenced by this page in one read
+        key_envelopes = _load_key_envelopes(db, {data.get("envelope_id") for _, data in docs})
+
+        # Only KEM decapsulation is worth a pool thread: unwrap the keys this
+        # session has not cached yet, many of them in parallel, then decrypt
+        # every message inline with cached keys
+        wraps = pending_key_wraps((data for _, data in docs), current_user_id, session_id, key_envelopes)
+        decrypt_pool.map(
+            lambda wrap: unwrap_aes_key(*wrap, private_key, cache_scope=session_id, cache_ttl=session_ttl),
+            wraps,
+            chunk_size=DECRYPT_CHUNK_SIZE,
+            threshold=DECRYPT_PARALLEL_THRESHOLD,
+        )
+        all_msgs = [
+            _decrypted_message(
+                msg_id, data, current_user_id, private_key, cache_scope=session_id, cache_ttl=session_ttl,
+                key_envelopes=key_envelopes,
             )
+            for msg_id, data in docs
+        ]
 
-        # Sort messages by timestamp
-        all_msgs.sort(key=lambda m: m["timestamp"])
+        with timed("json"):
+            response = jsonify(all_msgs)
+        return response, 200
+
+    except Exception as e:
+        return jsonify({"error": f"Failed to fetch messages: {str(e)}"}), 500
 
 
-        for eachmsg in all_msgs:
-            decrypted_message = decrypt_message(eachmsg, current_user_id, private_key)
-            eachmsg["message"] = decrypted_message
+def _wants_ndjson():
+    if request.args.get("format") == "ndjson":
+        return True
+    best = request.accept_mimetypes.best_match(["application/json", "application/x-ndjson"])
+    return best == "application/x-ndjson"
 
 
-        return jsonify(all_msgs), 200
+def _ndjson_messages(db, docs, current_user_id, private_key, session_id, session_ttl, key_envelopes):
+    """Decrypt and yield one JSON line per message, fetching key envelopes as they show up.
 
+    The headers are sent by then, so failures become records in the body:
+    {"id": ..., "error": ...} for a message that cannot be decrypted, and a
+    final {"error": ...} if the page itself cannot be read to the end.
+    """
+    try:
+        for msg_id, data in docs:
+            try:
+                envelope_id = data.get("envelope_id")
+                if envelope_id and envelope_id not in key_envelopes:
+                    key_envelopes.update(_load_key_envelopes(db, [envelope_id]))
+                msg = _decrypted_message(
+                    msg_id, data, current_user_id, private_key, cache_scope=session_id, cache_ttl=session_ttl,
+                    key_envelopes=key_envelopes,
+                )
+            except Exception as e:
+                print(f"⚠️ Warning: Could not decrypt message {msg_id}: {e}")
+                yield json.dumps({"id": msg_id, "error": "Could not decrypt message"}) + "\n"
+                continue
+            yield json.dumps(msg) + "\n"
     except Exception as e:
-        return jsonify({"error": f"Failed to fetch messages: {str(e)}"}), 500
\ No newline at end of file
+        print(f"⚠️ Warning: Message stream for get_messages broke off: {e}")
+        yield json.dumps({"error": f"Failed to fetch messages: {str(e)}"}) + "\n"
+
+
+def _load_key_envelopes(db, envelope_ids):
+    """Fetch key_envelopes documents by id, returns {envelope_id: data}."""
+    envelopes_ref = db.collection("key_envelopes")
+    refs = [envelopes_ref.document(envelope_id) for envelope_id in envelope_ids if envelope_id]
+    if not refs:
+        return {}
+    return {snap.id: snap.to_dict() for snap in timed_iter("firestore.read", db.get_all(refs)) if snap.exists}
+
+
+def _decrypted_message(msg_id, data, current_user_id, private_key, cache_scope=None, cache_ttl=None,
+                       key_envelopes=None):
+    """Client view of a stored message, with the plaintext in place of the ciphertext.
+
+    `sent_at` orders the conversation, it goes back as the page token's sent_at.
+    """
+    sent_at = data.get("sent_at")
+    if isinstance(sent_at, datetime):
+        sent_at = sent_at.isoformat()
+    return {
+        "id": msg_id,
+        "from": data["from"],
+        "to": data["to"],
+        "message": decrypt_message(
+            data, current_user_id, private_key, cache_scope, cache_ttl, key_envelopes=key_envelopes
+        ),
+        "timestamp": data["timestamp"],
+        "sent_at": sent_at,
+    }
@@ -8,7 +8,11 @@ import secrets
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives import padding 
-from kyber import KyberWrapper
+from kyber import get_kyber
+from cache import TTLCache
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from metrics import timed
+from envelope import read_message_fields, pack_sealed_payload, CIPHER_GCM
 import hashlib
 
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
@@ -18,9 +22,15 @@ load_dotenv()
 
 PBKDF2_ITERATIONS = int(os.getenv("PBKDF2_ITERATIONS", 100000))
 BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", 12))
+AES_KEY_CACHE_SIZE = int(os.getenv("AES_KEY_CACHE_SIZE", 4096))
+AES_KEY_CACHE_TTL = int(os.getenv("AES_KEY_CACHE_TTL", 3600))
+
+# Unwrapped session AES keys with their AESGCM instance, keyed by (session
+# id, digest of the KEM wrap), and each session's sealing key by (session id, "seal")
+_aes_key_cache = TTLCache(maxsize=AES_KEY_CACHE_SIZE, ttl=AES_KEY_CACHE_TTL)
 
 def generate_key_pair():
-    kyber = KyberWrapper()
+    kyber = get_kyber()
     public_key, private_key = kyber.generate_keypair()
     return public_key, private_key
 
@@ -46,12 +56,15 @@ def validate_username(username):
         return False, "Username can only contain letters, numbers, and underscores"
     return True, "Username is valid"
 
+@timed("kdf.bcrypt")
 def hash_password(password):
     return bcrypt.hashpw(password.encode(), bcrypt.gensalt(BCRYPT_ROUNDS)).decode()
 
+@timed("kdf.bcrypt")
 def check_password(password, hashed):
     return bcrypt.checkpw(password.encode(), hashed.encode())
 
+@timed("kdf.pbkdf2")
 def encrypt_secret_key(secret_key_hex, password, salt, iv):
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
@@ -73,7 +86,7 @@ def encrypt_secret_key(secret_key_hex, password, salt, iv):
 
 #encrypt aes key, given the user's private key and the aes key to be encrypted
 def encrypt_aes_key(private_key, aes_key):
-    kyber = KyberWrapper()
+    kyber = get_kyber()
     ciphertext, shared_secret = kyber.encapsulate(private_key)
     key_user = hashlib.sha256(shared_secret).digest()
     iv_user = secrets.token_bytes(16)
@@ -100,6 +113,37 @@ def encrypt_message(aes_key,message,iv_message):
     return encrypted_message
 
 
+def _message_aad(sender_id, receiver_id):
+    # Binds a sealed message to its sender and receiver
+    return f"{sender_id}>{receiver_id}".encode()
+
+
+def _sealing_aead(aes_key, cache_scope, cache_ttl):
+    # The session's AESGCM instance, set up once instead of per message
+    if cache_scope is None:
+        return AESGCM(aes_key)
+    cache_key = (cache_scope, "seal")
+    cached = _aes_key_cache.get(cache_key)
+    if cached is not None and cached[0] == aes_key:
+        return cached[1]
+    aead = AESGCM(aes_key)
+    _aes_key_cache.set(cache_key, (aes_key, aead), ttl=cache_ttl)
+    return aead
+
+
+@timed("aes.message")
+def seal_message(aes_key, message, sender_id, receiver_id, cache_scope=None, cache_ttl=None):
+    """Encrypt a message with AES-256-GCM into a version 3 payload envelope.
+
+    `cache_scope` and `cache_ttl` work as in unwrap_aes_key.
+    """
+    nonce = secrets.token_bytes(12)
+    aead = _sealing_aead(aes_key, cache_scope, cache_ttl)
+    encrypted_message = aead.encrypt(nonce, message.encode(), _message_aad(sender_id, receiver_id))
+    return pack_sealed_payload(encrypted_message, nonce)
+
+
+@timed("kdf.pbkdf2")
 def decrypt_secret_key(encrypted_sk_hex, password, salt_hex, iv_hex):
     kdf = PBKDF2HMAC(
         algorithm=hashes.SHA256(),
@@ -117,27 +161,33 @@ def decrypt_secret_key(encrypted_sk_hex, password, salt_hex, iv_hex):
     return (unpadder.update(decrypted_padded) + unpadder.finalize()).hex()
 
 
-def decrypt_message(message_doc: dict, current_user_id, private_key):
-    kyber = KyberWrapper()
-    if current_user_id == message_doc.get("to"):
-        # Receiver
-        ciphertext = bytes.fromhex(message_doc.get("receiver_ciphertext"))
-        encrypted_aes_key = bytes.fromhex(message_doc.get("receiver_encrypted_key"))
-        iv_aes = bytes.fromhex(message_doc.get("receiver_iv"))
-    else:
-        # Sender
-        ciphertext = bytes.fromhex(message_doc.get("sender_ciphertext"))
-        encrypted_aes_key = bytes.fromhex(message_doc.get("sender_encrypted_key"))
-        iv_aes = bytes.fromhex(message_doc.get("sender_iv"))
+def unwrap_aes_key(ciphertext, encrypted_aes_key, iv_aes, private_key, cache_scope=None, cache_ttl=None):
+    """Recover a wrapped AES key, reusing earlier results for the same session.
+
+    `cache_scope` is the session id the private key belongs to and
+    `cache_ttl` the session's remaining lifetime, so cached keys never
+    outlive the session that unwrapped them.
+    """
+    return _unwrap(ciphertext, encrypted_aes_key, iv_aes, private_key, cache_scope, cache_ttl)[0]
+
+
+def _wrap_cache_key(cache_scope, ciphertext, encrypted_aes_key, iv_aes):
+    return (cache_scope, hashlib.sha256(ciphertext + encrypted_aes_key + iv_aes).digest())
 
-    # print("Decapsulating with private key")
-    # print("Ciphertext:", ciphertext.hex())
+
+def _unwrap(ciphertext, encrypted_aes_key, iv_aes, private_key, cache_scope, cache_ttl):
+    # (aes_key, AESGCM instance), cached together so cached keys skip key setup
+    cache_key = None
+    if cache_scope is not None:
+        cache_key = _wrap_cache_key(cache_scope, ciphertext, encrypted_aes_key, iv_aes)
+        cached = _aes_key_cache.get(cache_key)
+        if cached is not None:
+            return cached
 
     # Derive shared secret using Kyber decapsulation
+    kyber = get_kyber()
     shared_secret = kyber.decapsulate(ciphertext, private_key)
     key_aes_key = hashlib.sha256(shared_secret).digest()
-    # print("Shared Secret:", shared_secret.hex())
-    # print("Derived Key:", key_aes_key.hex())
 
     # Decrypt AES key using AES
     cipher_for_aes_key = Cipher(algorithms.AES(key_aes_key), modes.CBC(iv_aes))
@@ -146,15 +196,67 @@ def decrypt_message(message_doc: dict, current_user_id, private_key):
     unpadder = padding.PKCS7(128).unpadder()
     aes_key = unpadder.update(padded_aes_key) + unpadder.finalize()
 
+    unwrapped = (aes_key, AESGCM(aes_key))
+    if cache_key is not None:
+        _aes_key_cache.set(cache_key, unwrapped, ttl=cache_ttl)
+    return unwrapped
+
+
+def forget_session_keys(cache_scope):
+    """Drop every cached AES key unwrapped by the given session."""
+    _aes_key_cache.discard_where(lambda key: key[0] == cache_scope)
+
+
+def _key_wrap(fields, message_doc, current_user_id):
+    # (ciphertext, encrypted key, iv) of the wrap the current user can open
+    side = "receiver" if current_user_id == message_doc.get("to") else "sender"
+    return fields[f"{side}_ciphertext"], fields[f"{side}_encrypted_key"], fields[f"{side}_iv"]
+
+
+def pending_key_wraps(message_docs, current_user_id, cache_scope, key_envelopes=None):
+    """Distinct key wraps of these messages that the session has not unwrapped yet.
+
+    Each is one KEM decapsulation, messages whose key is cached only need AES.
+    """
+    pending = {}
+    seen = set()
+    for message_doc in message_docs:
+        # Messages that share a key envelope share its wraps
+        envelope_id = message_doc.get("envelope_id")
+        if envelope_id:
+            side = (envelope_id, current_user_id == message_doc.get("to"))
+            if side in seen:
+                continue
+            seen.add(side)
+        wrap = _key_wrap(read_message_fields(message_doc, key_envelopes), message_doc, current_user_id)
+        if _aes_key_cache.get(_wrap_cache_key(cache_scope, *wrap)) is None:
+            pending[wrap] = None
+    return list(pending)
+
+
+def decrypt_message(message_doc: dict, current_user_id, private_key, cache_scope=None, cache_ttl=None,
+                    key_envelopes=None):
+    # Works on every stored layout, `key_envelopes` resolves referenced key wraps
+    fields = read_message_fields(message_doc, key_envelopes)
+    ciphertext, encrypted_aes_key, iv_aes = _key_wrap(fields, message_doc, current_user_id)
+
+    aes_key, aead = _unwrap(ciphertext, encrypted_aes_key, iv_aes, private_key, cache_scope, cache_ttl)
+
     # Decrypt the actual message
-    iv_message = bytes.fromhex(message_doc.get("iv_message"))
-    encrypted_message = bytes.fromhex(message_doc.get("message"))
+    iv_message = fields["iv_message"]
+    encrypted_message = fields["message"]
 
-    cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv_message))
-    decryptor = cipher.decryptor()
-    padded_plaintext = decryptor.update(encrypted_message) + decryptor.finalize()
+    with timed("aes.message"):
+        if fields["cipher"] == CIPHER_GCM:
+            # Raises InvalidTag if the message was tampered with
+            aad = _message_aad(message_doc["from"], message_doc["to"])
+            return aead.decrypt(iv_message, encrypted_message, aad).decode()
 
-    unpadder = padding.PKCS7(128).unpadder()
-    plaintext = unpadder.update(padded_plaintext) + unpadder.finalize()
+        cipher = Cipher(algorithms.AES(aes_key), modes.CBC(iv_message))
+        decryptor = cipher.decryptor()
+        padded_plaintext = decryptor.update(encrypted_message) + decryptor.finalize()
+
+        unpadder = padding.PKCS7(128).unpadder()
+        plaintext = unpadder.update(padded_plaintext) + unpadder.finalize()
 
     return plaintext.decode()
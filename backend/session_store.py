@@ -0,0 +1,481 @@
+# ---- Session store: login sessions, small shared caches and pub/sub ----
+#
+# A session is the hash session:<id>, expiring SESSION_TTL seconds after its
+# last use. The same store also holds short-lived cache entries and carries
+# pub/sub messages, so the backend needs nothing else from Redis.
+#
+# SESSION_BACKEND selects the implementation: "redis" (default) shares one
+# connection pool per process across all threads, "memory" keeps everything
+# in this process for tests, load tests and single-node runs.
+#
+# SessionCache keeps whole sessions in each worker for SESSION_CACHE_TTL
+# seconds, so authenticating a request rarely needs Redis at all. Redis
+# keyspace notifications on session:* keys drop a cached session as soon
+# as it is written to, deleted or expires anywhere.
+
+import os
+import queue
+from abc import ABC, abstractmethod
+import threading
+import time
+import redis
+from dotenv import load_dotenv
+from cache import TTLCache
+from metrics import timed
+
+load_dotenv()
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", 3600))
+SESSION_BACKEND = os.getenv("SESSION_BACKEND", "redis").lower()
+
+REDIS_MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", 64))
+REDIS_POOL_TIMEOUT = float(os.getenv("REDIS_POOL_TIMEOUT", 5))
+REDIS_SOCKET_TIMEOUT = float(os.getenv("REDIS_SOCKET_TIMEOUT", 5))
+REDIS_CONNECT_TIMEOUT = float(os.getenv("REDIS_CONNECT_TIMEOUT", 2))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv("REDIS_HEALTH_CHECK_INTERVAL", 30))
+
+SESSION_CACHE_ENABLED = os.getenv("SESSION_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", 10000))
+SESSION_CACHE_TTL = float(os.getenv("SESSION_CACHE_TTL", 5))
+
+# Keyspace events: K keyspace channel, g generic (del, expire), h hash, x expired
+KEYSPACE_EVENTS = "Kghx"
+
+# Write fields and refresh the TTL only if the session still exists, so a
+# late write cannot bring an expired session back to life
+_UPDATE_IF_EXISTS = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], unpack(ARGV, 2))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+
+def session_key(session_id):
+    return f"session:{session_id}"
+
+
+class SessionStore(ABC):
+    """Interface shared by the Redis and in-memory stores."""
+
+    session_ttl = SESSION_TTL
+
+    # Sessions
+    @abstractmethod
+    def create(self, session_id, fields):
+        """Store a new session with all its fields and start its TTL."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_all(self, session_id, refresh=False):
+        """Fetch every field of a session, optionally sliding the TTL.
+
+        Returns ({field: value}, remaining ttl in seconds), or (None, None)
+        when the session does not exist.
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def update(self, session_id, fields):
+        """Set fields on a live session and refresh its TTL, False if it expired."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ttl(self, session_id):
+        """Remaining lifetime in seconds, None once the session is gone."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete(self, session_id):
+        raise NotImplementedError
+
+    # Cache entries
+    @abstractmethod
+    def get(self, key):
+        raise NotImplementedError
+
+    @abstractmethod
+    def set(self, key, value, ex=None, nx=False):
+        """Store a value, with nx only if the key does not exist yet."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def delete_keys(self, *keys):
+        raise NotImplementedError
+
+    # Pub/sub
+    @abstractmethod
+    def publish(self, channel, message):
+        raise NotImplementedError
+
+    @abstractmethod
+    def subscribe(self, channel):
+        """Subscription whose get_message(timeout) returns a payload or None."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ping(self):
+        """Raise if the backend cannot be reached."""
+        raise NotImplementedError
+
+
+# ---- Redis ----
+
+def redis_from_env():
+    """Redis client on a bounded, blocking connection pool configured from the environment.
+
+    Threads wait up to REDIS_POOL_TIMEOUT for a free connection instead of
+    opening new ones without limit.
+    """
+    pool = redis.BlockingConnectionPool(
+        host=os.getenv('REDIS_HOST', 'localhost'),
+        port=int(os.getenv('REDIS_PORT', 6379)),
+        db=int(os.getenv('REDIS_DB', 0)),
+        decode_responses=True,
+        max_connections=REDIS_MAX_CONNECTIONS,
+        timeout=REDIS_POOL_TIMEOUT,
+        socket_timeout=REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=REDIS_CONNECT_TIMEOUT,
+        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+    )
+    return redis.Redis(connection_pool=pool)
+
+
+class _RedisSubscription:
+    def __init__(self, pubsub):
+        self._pubsub = pubsub
+
+    def get_message(self, timeout):
+        event = self._pubsub.get_message(timeout=timeout)
+        return event["data"] if event else None
+
+    def close(self):
+        self._pubsub.close()
+
+
+class RedisSessionStore(SessionStore):
+    """Every operation costs a single round trip to Redis."""
+
+    def __init__(self, redis_client, ttl=SESSION_TTL):
+        self.redis = redis_client
+        self.session_ttl = ttl
+        self._update_if_exists = redis_client.register_script(_UPDATE_IF_EXISTS)
+
+    @timed("redis")
+    def create(self, session_id, fields):
+        key = session_key(session_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(key, mapping=fields)
+        pipe.expire(key, self.session_ttl)
+        pipe.execute()
+
+    @timed("redis")
+    def read_all(self, session_id, refresh=False):
+        key = session_key(session_id)
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.hgetall(key)
+        if refresh:
+            pipe.expire(key, self.session_ttl)
+        pipe.ttl(key)
+        results = pipe.execute()
+        ttl = results[-1]
+        if not results[0] or ttl <= 0:
+            return None, None
+        return results[0], ttl
+
+    @timed("redis")
+    def update(self, session_id, fields):
+        args = [self.session_ttl]
+        for name, value in fields.items():
+            args.extend((name, value))
+        return bool(self._update_if_exists(keys=[session_key(session_id)], args=args))
+
+    @timed("redis")
+    def ttl(self, session_id):
+        ttl = self.redis.ttl(session_key(session_id))
+        return ttl if ttl > 0 else None
+
+    @timed("redis")
+    def delete(self, session_id):
+        self.redis.delete(session_key(session_id))
+
+    @timed("redis")
+    def get(self, key):
+        return self.redis.get(key)
+
+    @timed("redis")
+    def set(self, key, value, ex=None, nx=False):
+        self.redis.set(key, value, ex=ex, nx=nx)
+
+    @timed("redis")
+    def delete_keys(self, *keys):
+        if keys:
+            self.redis.delete(*keys)
+
+    @timed("redis")
+    def publish(self, channel, message):
+        self.redis.publish(channel, message)
+
+    @timed("redis")
+    def subscribe(self, channel):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        return _RedisSubscription(pubsub)
+
+    def ping(self):
+        self.redis.ping()
+
+
+# ---- In-memory ----
+
+class _MemorySubscription:
+    def __init__(self, store, channel):
+        self._store = store
+        self._channel = channel
+        self._queue = queue.Queue()
+
+    def get_message(self, timeout):
+        try:
+            return self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self._store._unsubscribe(self._channel, self)
+
+
+class MemorySessionStore(SessionStore):
+    """Process-local stand-in for Redis, sessions are not shared between workers."""
+
+    def __init__(self, ttl=SESSION_TTL):
+        self.session_ttl = ttl
+        self._data = {}  # key -> [value, expires_at or None]
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key):
+        # Caller holds the lock
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        if entry[1] is not None and entry[1] <= time.monotonic():
+            del self._data[key]
+            return None
+        return entry
+
+    def create(self, session_id, fields):
+        with self._lock:
+            self._data[session_key(session_id)] = [
+                {name: str(value) for name, value in fields.items()},
+                time.monotonic() + self.session_ttl,
+            ]
+
+    def read_all(self, session_id, refresh=False):
+        with self._lock:
+            entry = self._live(session_key(session_id))
+            if entry is None:
+                return None, None
+            if refresh:
+                entry[1] = time.monotonic() + self.session_ttl
+            remaining = int(entry[1] - time.monotonic())
+            if remaining <= 0:
+                return None, None
+            return dict(entry[0]), remaining
+
+    def update(self, session_id, fields):
+        with self._lock:
+            entry = self._live(session_key(session_id))
+            if entry is None:
+                return False
+            entry[0].update({name: str(value) for name, value in fields.items()})
+            entry[1] = time.monotonic() + self.session_ttl
+            return True
+
+    def ttl(self, session_id):
+        with self._lock:
+            entry = self._live(session_key(session_id))
+            if entry is None:
+                return None
+            remaining = int(entry[1] - time.monotonic())
+            return remaining if remaining > 0 else None
+
+    def delete(self, session_id):
+        self.delete_keys(session_key(session_id))
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._live(key) is not None:
+                return
+            self._data[key] = [value, time.monotonic() + ex if ex else None]
+
+    def delete_keys(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._data.pop(key, None)
+
+    def publish(self, channel, message):
+        with self._lock:
+            subscribers = list(self._channels.get(channel, ()))
+        for subscription in subscribers:
+            subscription._queue.put(message)
+
+    def subscribe(self, channel):
+        subscription = _MemorySubscription(self, channel)
+        with self._lock:
+            self._channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def _unsubscribe(self, channel, subscription):
+        with self._lock:
+            subscribers = self._channels.get(channel)
+            if subscribers:
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._channels[channel]
+
+    def ping(self):
+        pass
+
+
+# ---- Per-worker near-cache ----
+
+class SessionCache:
+    """Sessions read through a short-lived in-process cache.
+
+    Entries are only cached while the keyspace listener is connected, so a
+    missed invalidation can never outlive SESSION_CACHE_TTL. Without a
+    Redis store every load goes to the store.
+    """
+
+    def __init__(self, store, maxsize=SESSION_CACHE_SIZE, ttl=SESSION_CACHE_TTL):
+        self.store = store
+        self.redis = getattr(store, "redis", None) if SESSION_CACHE_ENABLED and ttl > 0 else None
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Forked children start their own listener with an empty cache
+        self._cache.clear()
+        self._listening = False
+        # Bumped under _lock on every invalidation, a load only caches what it
+        # read if no event arrived in between
+        self._generation = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def load(self, session_id):
+        """(fields, remaining ttl) of a live session, sliding its TTL; (None, None) if it is gone."""
+        cached = self._cache.get(session_id)
+        if cached is not None:
+            fields, expires_at = cached
+            return fields, max(int(expires_at - time.monotonic()), 1)
+
+        self.start()
+        with self._lock:
+            generation = self._generation
+        fields, ttl = self.store.read_all(session_id, refresh=True)
+        if fields is not None and self._listening:
+            with self._lock:
+                if generation == self._generation:
+                    self._cache.set(session_id, (fields, time.monotonic() + ttl))
+        return fields, ttl
+
+    def invalidate(self, session_id):
+        """Drop a session from this worker's cache, e.g. right after writing to it."""
+        with self._lock:
+            self._generation += 1
+            self._cache.pop(session_id)
+
+    def _expire_changed(self, session_id):
+        """Whether an EXPIRE left the session shorter-lived than its cached copy.
+
+        Every TTL refresh fires an expire event too, including our own, so
+        only a shortened TTL counts as a change.
+        """
+        cached = self._cache.get(session_id)
+        if cached is None:
+            return False
+        pttl = self.redis.pttl(session_key(session_id))
+        if pttl == -1:
+            return False
+        # The cached expiry is rounded down to whole seconds
+        return pttl < 0 or time.monotonic() + pttl / 1000 < cached[1] - 1
+
+    def start(self):
+        """Start the keyspace listener of this process, if there is one to start."""
+        if self.redis is None or self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen, name="session-cache", daemon=True)
+                self._thread.start()
+
+    def _enable_notifications(self):
+        try:
+            current = self.redis.config_get("notify-keyspace-events").get("notify-keyspace-events", "")
+            missing = "".join(flag for flag in KEYSPACE_EVENTS if flag not in current and "A" not in current)
+            if missing:
+                self.redis.config_set("notify-keyspace-events", current + missing)
+        except redis.exceptions.ResponseError as e:
+            # Managed Redis often disables CONFIG, the setting must then be
+            # made in the provider's parameter settings
+            print(f"⚠️ Warning: Could not enable keyspace notifications, "
+                  f"set notify-keyspace-events to include {KEYSPACE_EVENTS}: {e}")
+
+    def _listen(self):
+        db = self.redis.connection_pool.connection_kwargs.get("db", 0)
+        pattern = f"__keyspace@{db}__:{session_key('*')}"
+        prefix_length = len(f"__keyspace@{db}__:{session_key('')}")
+        backoff = 0.5
+        while True:
+            pubsub = None
+            try:
+                self._enable_notifications()
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                pubsub.psubscribe(pattern)
+                self._listening = True
+                backoff = 0.5
+                while True:
+                    event = pubsub.get_message(timeout=1.0)
+                    if not event:
+                        continue
+                    session_id = event["channel"][prefix_length:]
+                    if event["data"] == "expire" and not self._expire_changed(session_id):
+                        continue
+                    with self._lock:
+                        self._generation += 1
+                        self._cache.pop(session_id)
+            except Exception as e:
+                print(f"⚠️ Warning: Session cache listener failed, retrying in {backoff:.1f}s: {e}")
+            finally:
+                # Events may be lost from here on, stop trusting cached sessions
+                self._listening = False
+                with self._lock:
+                    self._generation += 1
+                    self._cache.clear()
+                if pubsub is not None:
+                    pubsub.close()
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+
+
+def create_session_cache(store):
+    """Near-cache in front of a session store."""
+    return SessionCache(store)
+
+
+def create_session_store(backend=SESSION_BACKEND):
+    """Build the store selected by SESSION_BACKEND."""
+    if backend == "memory":
+        return MemorySessionStore()
+    if backend == "redis":
+        return RedisSessionStore(redis_from_env())
+    raise ValueError(f"Unknown SESSION_BACKEND {backend!r}, expected 'redis' or 'memory'")
@@ -79,15 +79,9 @@ print("✅ Shared secret matches.")
 
 #testing how redis works with null values
 
-import redis
-import os
-#redis setup
-redis_client = redis.Redis(
-    host=os.getenv('REDIS_HOST', 'localhost'),
-    port=int(os.getenv('REDIS_PORT', 6379)),
-    db=int(os.getenv('REDIS_DB', 0)),
-    decode_responses=True
-)
+from session_store import redis_from_env
+#redis setup, the same pooled client the backend uses
+redis_client = redis_from_env()
 
 session_id = "test_session"
 encrypted_aes_key = redis_client.get(f'session:{session_id}:aes_key')
@@ -0,0 +1,148 @@
+# ---- Username lookups without a Firestore query ----
+#
+# The Redis hash username:index maps usernames to user ids, and the bit
+# string username:bloom is a Bloom filter over the same names. User.save
+# adds every new user to both. Usernames never change and users are never
+# deleted, so entries only ever get added.
+#
+# A hit in the hash is checked against the user document it names. A miss
+# is only trusted once rebuild() has indexed every existing user and set
+# username:index:ready: then a negative Bloom filter answer proves a name
+# is free without touching Firestore, which is the common case while
+# registering. Everything else falls back to the Firestore query, which
+# stays the source of truth and fills the index as it goes.
+
+import hashlib
+import math
+import os
+from dotenv import load_dotenv
+import redis
+from metrics import timed, timed_iter
+
+load_dotenv()
+
+USERNAME_INDEX_ENABLED = os.getenv("USERNAME_INDEX_ENABLED", "true").lower() in ("1", "true", "yes")
+USERNAME_BLOOM_CAPACITY = int(os.getenv("USERNAME_BLOOM_CAPACITY", 1000000))
+USERNAME_BLOOM_ERROR_RATE = float(os.getenv("USERNAME_BLOOM_ERROR_RATE", 0.001))
+
+INDEX_KEY = "username:index"
+BLOOM_KEY = "username:bloom"
+READY_KEY = "username:index:ready"
+
+
+def bloom_size(capacity, error_rate):
+    """Bits and hash functions of a Bloom filter for `capacity` names."""
+    bits = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+    hashes = max(1, round(bits / capacity * math.log(2)))
+    return bits, hashes
+
+
+class UsernameIndex:
+    """Redis hash and Bloom filter over all registered usernames."""
+
+    def __init__(self, redis_client, capacity=USERNAME_BLOOM_CAPACITY, error_rate=USERNAME_BLOOM_ERROR_RATE):
+        self.redis = redis_client
+        self.bits, self.hashes = bloom_size(capacity, error_rate)
+
+    def _positions(self, username):
+        # Double hashing: k positions from two 64-bit halves of one digest
+        digest = hashlib.blake2b(username.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "big")
+        h2 = int.from_bytes(digest[8:], "big") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    @timed("redis")
+    def lookup(self, username):
+        """User id indexed for `username`, or None if it is not in the hash."""
+        try:
+            return self.redis.hget(INDEX_KEY, username)
+        except redis.exceptions.RedisError as e:
+            print(f"⚠️ Warning: Username index lookup failed, using Firestore: {e}")
+            return None
+
+    @timed("redis")
+    def might_exist(self, username):
+        """False only when the index is complete and the Bloom filter rules the name out."""
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            pipe.exists(READY_KEY)
+            for position in self._positions(username):
+                pipe.getbit(BLOOM_KEY, position)
+            ready, *bits = pipe.execute()
+        except redis.exceptions.RedisError as e:
+            print(f"⚠️ Warning: Username filter check failed, using Firestore: {e}")
+            return True
+        return not ready or all(bits)
+
+    @timed("redis")
+    def add(self, username, user_id):
+        """Index a user; on failure the index stops answering for absent names."""
+        try:
+            self._add(self.redis.pipeline(transaction=False), username, user_id).execute()
+        except redis.exceptions.RedisError as e:
+            print(f"⚠️ Warning: Could not index username {username}: {e}")
+            try:
+                # A missing entry must not make a taken name look free
+                self.redis.delete(READY_KEY)
+            except redis.exceptions.RedisError:
+                pass
+
+    def _add(self, pipe, username, user_id):
+        pipe.hset(INDEX_KEY, username, user_id)
+        for position in self._positions(username):
+            pipe.setbit(BLOOM_KEY, position, 1)
+        return pipe
+
+    def rebuild(self, db, batch_size=500, reset=False):
+        """Index every user document and mark the index ready, returns the count.
+
+        Users registered meanwhile are added by User.save as usual. Pass
+        `reset` after changing the Bloom filter size or error rate.
+        """
+        if reset:
+            self.redis.delete(READY_KEY, INDEX_KEY, BLOOM_KEY)
+
+        users_ref = db.collection("users")
+        indexed = 0
+        last_doc = None
+        while True:
+            query = users_ref.order_by("__name__").select(["username"]).limit(batch_size)
+            if last_doc is not None:
+                query = query.start_after(last_doc)
+            docs = list(timed_iter("firestore.read", query.stream()))
+            if not docs:
+                break
+            last_doc = docs[-1]
+
+            pipe = self.redis.pipeline(transaction=False)
+            for doc in docs:
+                username = (doc.to_dict() or {}).get("username")
+                if username:
+                    self._add(pipe, username, doc.id)
+                    indexed += 1
+            pipe.execute()
+
+        self.redis.set(READY_KEY, 1)
+        return indexed
+
+
+def create_username_index(session_store):
+    """Index on the session store's Redis, or None to always query Firestore."""
+    redis_client = getattr(session_store, "redis", None)
+    if not USERNAME_INDEX_ENABLED or redis_client is None:
+        return None
+    return UsernameIndex(redis_client)
+
+
+if __name__ == "__main__":
+    # Build the index from Firestore, run once after deploying and after
+    # changing USERNAME_BLOOM_CAPACITY or USERNAME_BLOOM_ERROR_RATE (--reset)
+    import argparse
+    from firebase_init import get_db
+    from session_store import redis_from_env
+
+    parser = argparse.ArgumentParser(description="Rebuild the Redis username index and Bloom filter")
+    parser.add_argument("--reset", action="store_true", help="drop the current index first")
+    args = parser.parse_args()
+
+    print(f"Indexed {UsernameIndex(redis_from_env()).rebuild(get_db(), reset=args.reset)} usernames")
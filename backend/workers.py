@@ -0,0 +1,128 @@
+# ---- Bounded worker pools for CPU-heavy request work ----
+#
+# bcrypt, PBKDF2 and AES (OpenSSL) and the Kyber library all release the GIL
+# while they run, so a small thread pool caps how many of them burn CPU at
+# once. A request waiting on the KDF pool still holds its request thread,
+# so the pool admits fewer jobs than the worker has threads: at least
+# KDF_RESERVED_THREADS stay free for streams and cheap endpoints, and a
+# login burst beyond that gets 503 instead of starving them.
+
+import contextvars
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Request threads of a gunicorn worker, see gunicorn.conf.py
+REQUEST_THREADS = int(os.getenv("GUNICORN_THREADS", 8))
+
+KDF_WORKERS = int(os.getenv("KDF_WORKERS", max(1, (os.cpu_count() or 2) // 2)))
+KDF_QUEUE_LIMIT = int(os.getenv("KDF_QUEUE_LIMIT", 16))
+KDF_RESERVED_THREADS = int(os.getenv("KDF_RESERVED_THREADS", REQUEST_THREADS // 2))
+KDF_RETRY_AFTER = int(os.getenv("KDF_RETRY_AFTER", 2))
+# Register and login requests in flight per worker, running or queued
+KDF_MAX_JOBS = max(1, min(KDF_WORKERS + KDF_QUEUE_LIMIT, REQUEST_THREADS - KDF_RESERVED_THREADS))
+
+DECRYPT_WORKERS = int(os.getenv("DECRYPT_WORKERS", os.cpu_count() or 2))
+DECRYPT_QUEUE_LIMIT = int(os.getenv("DECRYPT_QUEUE_LIMIT", 4 * DECRYPT_WORKERS))
+# Counted in key unwraps: a decapsulation takes tens of microseconds and a
+# pool chunk costs a few, so a handful of them already pays for the pool
+DECRYPT_CHUNK_SIZE = int(os.getenv("DECRYPT_CHUNK_SIZE", 2))
+DECRYPT_PARALLEL_THRESHOLD = int(os.getenv("DECRYPT_PARALLEL_THRESHOLD", 4))
+
+
+class PoolSaturated(Exception):
+    """Raised instead of queueing when a pool is already at capacity."""
+
+    def __init__(self, name, retry_after):
+        super().__init__(f"{name} pool is saturated, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class BoundedPool:
+    """Thread pool that admits at most `workers + queue_limit` jobs at a time.
+
+    `max_jobs` lowers that bound further, e.g. below the request thread count.
+    """
+
+    def __init__(self, name, workers, queue_limit, retry_after, max_jobs=None):
+        self.name = name
+        self.workers = workers
+        self.queue_limit = queue_limit
+        self.retry_after = retry_after
+        self.max_jobs = workers + queue_limit if max_jobs is None else min(max_jobs, workers + queue_limit)
+        self._reset()
+        os.register_at_fork(after_in_child=self._reset)
+
+    def _reset(self):
+        # Worker threads do not survive a fork, children start a fresh pool
+        self._executor = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.max_jobs)
+
+    def _get_executor(self):
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=self.workers, thread_name_prefix=self.name
+                    )
+        return self._executor
+
+    def _submit(self, fn, *args, **kwargs):
+        # Returns None instead of a future when no slot is free
+        if not self._slots.acquire(blocking=False):
+            return None
+        try:
+            # Jobs see the submitting request's context, e.g. its metrics
+            future = self._get_executor().submit(contextvars.copy_context().run, fn, *args, **kwargs)
+        except Exception:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def run(self, fn, *args, **kwargs):
+        """Run `fn` on the pool and wait for its result.
+
+        Raises PoolSaturated right away when no slot is free.
+        """
+        future = self._submit(fn, *args, **kwargs)
+        if future is None:
+            raise PoolSaturated(self.name, self.retry_after)
+        return future.result()
+
+    def map(self, fn, items, chunk_size, threshold=0):
+        """Apply `fn` to every item in chunks spread over the pool, results in input order.
+
+        Fewer than `threshold` items, and chunks that find no free slot, are
+        handled by the calling thread, so a busy pool only loses parallelism.
+        """
+        items = list(items)
+        if len(items) < threshold or len(items) <= chunk_size:
+            return [fn(item) for item in items]
+
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        # The caller keeps the first chunk, the others go to the pool
+        futures = [None] + [self._submit(_apply_all, fn, chunk) for chunk in chunks[1:]]
+        results = [None] * len(chunks)
+        for i, future in enumerate(futures):
+            if future is None:
+                results[i] = _apply_all(fn, chunks[i])
+        for i, future in enumerate(futures):
+            if future is not None:
+                results[i] = future.result()
+        return [result for chunk_results in results for result in chunk_results]
+
+
+def _apply_all(fn, chunk):
+    return [fn(item) for item in chunk]
+
+
+# Password hashing, key derivation and Kyber work for register and login
+kdf_pool = BoundedPool("kdf", KDF_WORKERS, KDF_QUEUE_LIMIT, KDF_RETRY_AFTER, max_jobs=KDF_MAX_JOBS)
+
+# Key unwraps (KEM decapsulations) of message history pages, see BoundedPool.map
+decrypt_pool = BoundedPool("decrypt", DECRYPT_WORKERS, DECRYPT_QUEUE_LIMIT, KDF_RETRY_AFTER)
@@ -1,10 +1,11 @@
-import React, { useEffect, useState } from "react";
+import React, { useEffect, useRef, useState } from "react";
 import { useParams, Outlet, useNavigate, useLocation, useOutletContext } from "react-router-dom";
 import { BsThreeDotsVertical } from "react-icons/bs";
 import { FaPlus } from "react-icons/fa6";
 import { IoMdSend } from "react-icons/io";
 import profileImg from "../assets/profile.png";
 import { AxiosClient } from "../utils/AxiosClient";
+import { openMessageStream } from "../utils/messageStream";
 import { Formik, Form, Field } from "formik";
 import * as Yup from "yup";
 import toast from "react-hot-toast";
@@ -23,6 +24,9 @@ const Chat = () => {
   const [isLoading, setIsLoading] = useState(true);
   const [isSending, setIsSending] = useState(false);
   const [isXL, setIsXL] = useState(window.innerWidth >= 1280);
+  // Newest message we hold, its id and sent_at are the page token for newer messages
+  const cursorRef = useRef(null);
+  const catchUpRef = useRef(null);
 
   useEffect(() => {
     const updateSize = () => setIsXL(window.innerWidth >= 1280);
@@ -59,25 +63,72 @@ const Chat = () => {
     if (!id) return;
     const token = localStorage.getItem("token");
     if (!token) return;
+    cursorRef.current = null;
+    setMessages([]);
+    const controller = new AbortController();
+    let retryTimer = null;
+
+    const appendMessages = (incoming) => {
+      if (incoming.length === 0) return;
+      setMessages((prev) => {
+        const seen = new Set(prev.map((msg) => msg.id));
+        return [...prev, ...incoming.filter((msg) => !seen.has(msg.id))];
+      });
+      const lastMsg = incoming[incoming.length - 1];
+      const order = (msg) => msg.sent_at || msg.timestamp;
+      if (!cursorRef.current || order(lastMsg) >= order(cursorRef.current)) {
+        cursorRef.current = lastMsg;
+      }
+      if (handleLatestMessage) handleLatestMessage(id, lastMsg.message);
+    };
+
+    // Fetch whatever is newer than the cursor: the history on first load,
+    // and anything missed while the stream was down
     const fetchMessages = async () => {
+      const cursor = cursorRef.current;
       try {
         const response = await AxiosClient.get(`/get_messages/${id}`, {
           headers: { Authorization: `Bearer ${token}` },
+          // sent_at lets the server page from a message it has not stored yet
+          params: cursor ? { after: cursor.id, ...(cursor.sent_at && { sent_at: cursor.sent_at }) } : {},
+          signal: controller.signal,
         });
-        setMessages(response.data);
-        if (handleLatestMessage && Array.isArray(response.data) && response.data.length > 0) {
-          const lastMsg = response.data[response.data.length - 1];
-          handleLatestMessage(id, lastMsg.message);
-        } else if (handleLatestMessage) {
+        const newMessages = Array.isArray(response.data) ? response.data : [];
+        appendMessages(newMessages);
+        if (cursor === null && newMessages.length === 0 && handleLatestMessage) {
           handleLatestMessage(id, "Start a conversation");
         }
       } catch (error) {
-        console.error("Failed to fetch messages:", error);
+        if (!controller.signal.aborted) console.error("Failed to fetch messages:", error);
+      }
+    };
+    catchUpRef.current = fetchMessages;
+
+    // New messages are pushed by the server, reconnect with a catch-up fetch.
+    // Every failed attempt polls once, so messages still arrive while the
+    // stream is down or the server has no stream to spare.
+    const listen = async () => {
+      let retryIn = 3000;
+      try {
+        await openMessageStream(id, token, fetchMessages, (msg) => appendMessages([msg]), controller.signal);
+      } catch (error) {
+        if (controller.signal.aborted) return;
+        if (error.busy) {
+          retryIn = error.retryAfter * 1000;
+        } else {
+          console.error("Message stream interrupted:", error);
+        }
+        await fetchMessages();
       }
+      if (!controller.signal.aborted) retryTimer = setTimeout(listen, retryIn);
+    };
+    listen();
+
+    return () => {
+      controller.abort();
+      clearTimeout(retryTimer);
+      catchUpRef.current = null;
     };
-    const interval = setInterval(fetchMessages, 3000);
-    fetchMessages();
-    return () => clearInterval(interval);
   }, [id, handleLatestMessage]);
 
   const handleClick = () => {
@@ -124,12 +175,9 @@ const Chat = () => {
         }
       );
       resetForm();
-      // Optionally, fetch messages again to update the chat
       setIsSending(false);
-      const response = await AxiosClient.get(`/get_messages/${id}`, {
-        headers: { Authorization: `Bearer ${token}` },
-      });
-      setMessages(response.data);
+      // The stream delivers the message too, this covers a stream that is reconnecting
+      if (catchUpRef.current) await catchUpRef.current();
     } catch (error) {
       toast.error(error?.response?.data?.error || "Failed to send message");
     } finally {
@@ -14,16 +14,24 @@ const Notification = () => {
   useEffect(() => {
     const fetchNotifications = async () => {
       try {
-        const response = await AxiosClient.get(
-          "/get_friend_accept_notifications",
-          {
-            headers: {
-              Authorization: `Bearer ${token}`,
-            },
-          }
-        );
+        const response = await AxiosClient.get("/notifications", {
+          headers: {
+            Authorization: `Bearer ${token}`,
+          },
+        });
 
-        setNotifications(response.data || []);
+        const items = response.data || [];
+        setNotifications(items);
+
+        // Mark what was just shown as read
+        const unread = items.filter((notif) => !notif.read).map((notif) => notif.id);
+        if (unread.length > 0) {
+          AxiosClient.post(
+            "/notifications/read",
+            { ids: unread },
+            { headers: { Authorization: `Bearer ${token}` } }
+          ).catch(() => {});
+        }
       } catch (error) {
         toast.error("Failed to fetch notifications.");
         setNotifications([]);
@@ -70,9 +78,15 @@ const Notification = () => {
                   <h1 className="font-semibold text-white/80">
                     {notif.username}
                   </h1>
-                  <p className="text-sm text-green-400 truncate">
-                    accepted your friend request
-                  </p>
+                  {notif.type === "decline" ? (
+                    <p className="text-sm text-red-400 truncate">
+                      declined your friend request
+                    </p>
+                  ) : (
+                    <p className="text-sm text-green-400 truncate">
+                      accepted your friend request
+                    </p>
+                  )}
                 </div>
 
                 <div className="ml-auto text-sm text-white/50">
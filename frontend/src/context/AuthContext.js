@@ -42,6 +42,15 @@ export const AuthContextProvider = ({ children }) => {
   };
 
   const logout = () => {
+    const token = localStorage.getItem("token");
+    if (token) {
+      // End the server session too, the token stops working right away
+      AxiosClient.post(
+        "/logout",
+        {},
+        { headers: { Authorization: `Bearer ${token}` } }
+      ).catch(() => {});
+    }
     localStorage.removeItem("token");
     localStorage.removeItem("username");
     setUser(null);
@@ -0,0 +1,50 @@
+import { AxiosClient } from "./AxiosClient";
+
+// Streams are served by the backend's gevent stream service when
+// REACT_APP_STREAM_URL points at it, and by the API itself otherwise
+const STREAM_URL = process.env.REACT_APP_STREAM_URL || AxiosClient.defaults.baseURL;
+
+// Reads the backend's Server-Sent Events stream with fetch, so the bearer
+// token can travel in the Authorization header like every other request.
+// `onOpen` runs once the server has subscribed, so a catch-up fetch there
+// cannot miss anything. Resolves when the server closes the stream. When the
+// server has no stream to spare it answers 503: the error then carries
+// `busy` and `retryAfter` (seconds), and the caller polls in the meantime.
+export const openMessageStream = async (friendId, token, onOpen, onMessage, signal) => {
+  const response = await fetch(`${STREAM_URL}/stream/${friendId}`, {
+    headers: { Authorization: `Bearer ${token}`, Accept: "text/event-stream" },
+    credentials: "include",
+    signal,
+  });
+  if (!response.ok || !response.body) {
+    const error = new Error(`Message stream failed with status ${response.status}`);
+    error.busy = response.status === 503;
+    error.retryAfter = Number(response.headers.get("Retry-After")) || 5;
+    throw error;
+  }
+  await onOpen();
+
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = "";
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) return;
+    buffer += decoder.decode(value, { stream: true });
+
+    let boundary;
+    while ((boundary = buffer.indexOf("\n\n")) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+
+      let event = "message";
+      const data = [];
+      for (const line of rawEvent.split("\n")) {
+        if (line.startsWith("event:")) event = line.slice(6).trim();
+        else if (line.startsWith("data:")) data.push(line.slice(5).trim());
+      }
+      if (event === "end") return;
+      if (event === "message" && data.length > 0) onMessage(JSON.parse(data.join("\n")));
+    }
+  }
+};